@@ -1,33 +1,90 @@
+import csv
 import datetime
+import functools
 import html
+import io
+import itertools
 import logging
 import os
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List
 
-import pandas as pd
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, ParseMode
-from telegram.ext import CallbackQueryHandler
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Message, Update, ParseMode
+from telegram.ext import CallbackQueryHandler, DispatcherHandlerStop
 from telegram.ext import Updater, CallbackContext, CommandHandler, ConversationHandler, MessageHandler, Filters
 
-from tools import read_config, read_csv, write_csv, read_currencies, run_request, save_currencies
+from dispatch import make_chat_pool_updater
+from bulk_import import read_import
+from drafts import ConversationPersistence, DraftExpense, DraftStore
+from keyboards import KeyboardCache
+from ledger import Ledger
+from quick_entry import amount_pattern, parse_date, parse_expense
+from rates import RateService, UnknownCurrencyError
+from storage import LedgerCache, find_layer, make_storage, shard_ledgers
+from tools import (
+    DISPLAY_DATE_FORMAT,
+    chunk_lines,
+    export_formats,
+    export_rows,
+    read_config,
+    remove_temp_files,
+)
+from webhook import run_webhook
 
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 outdir = "budget_csvs"
 df_columns = ["date", "amount", "category", "description"]
+NUMBER_OF_DAYS_TO_SEND = 9
+# bots can download files of up to 20 MB
+MAX_IMPORT_BYTES = 20 * 1024 * 1024
+CATEGORIES = [
+    "Supermarket",
+    "Eating Out",
+    "Drinking",
+    "Busses etc",
+    "Car Rental",
+    "Petrol",
+    "LocalTransport",
+    "Flights",
+    "Hotels",
+    "Trips",
+    "Various",
+]
 
 config = read_config(outdir)
-currencies = read_currencies(outdir)
 developer_chat_id = config["developer_chat_id"]
 bot_token = config["bot_token"]
 currency_exchange_api = config["currency_exchange_api"]
-
-expense_dates = dict()
-expense_amounts = dict()
-expense_currencies = dict()
-expense_categories = dict()
-expense_descriptions = dict()
+rates = RateService(
+    outdir,
+    currency_exchange_api,
+    config.get("currency_exchange_url", "https://api.apilayer.com/exchangerates_data"),
+    float(config.get("exchange_rate_ttl", 6 * 60 * 60)),
+    history_days=NUMBER_OF_DAYS_TO_SEND,
+)
+keyboards = KeyboardCache(rates, NUMBER_OF_DAYS_TO_SEND, CATEGORIES)
+paginate_expenses = config.get("paginate_expenses", False)
+storage = make_storage(config, outdir, df_columns)
+
+# "threads" (default) handles one update at a time, "parallel" handles the updates of different chats in parallel
+# threads (those of one chat stay in order) and runs independent Telegram calls and disk writes of one update at
+# the same time on io_executor. "async" is the former name of "parallel", neither uses asyncio.
+parallel_runtime = config.get("runtime", "threads") in ("parallel", "async")
+workers = int(config.get("workers", 8))
+io_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="io") if parallel_runtime else None
+
+# answers of the /spend conversation, with "persist_conversations" they and the conversation states survive restarts
+persist_conversations = config.get("persist_conversations", False)
+drafts = DraftStore(
+    max_size=int(config.get("max_drafts", 1000)),
+    ttl=float(config.get("draft_ttl", 24 * 60 * 60)),
+    path=os.path.join(outdir, "drafts.json") if persist_conversations else None,
+)
 
 (
     EXPENSE_DATE,
@@ -38,7 +95,17 @@ expense_descriptions = dict()
     EXPENSE_DESCRIPTION,
     ADD_CURRENCY,
 ) = range(7)
-NUMBER_OF_DAYS_TO_SEND = 9
+
+
+def run_concurrently(*calls: Callable) -> None:
+    """Run independent calls in parallel in the parallel runtime, one after another otherwise."""
+    if io_executor is None:
+        for call in calls:
+            call()
+        return
+
+    for future in [io_executor.submit(call) for call in calls]:
+        future.result()
 
 
 def start(update: Update, context: CallbackContext) -> int:
@@ -55,50 +122,59 @@ def start(update: Update, context: CallbackContext) -> int:
 
 
 def add_currency(update: Update, context: CallbackContext) -> int:
-    context.bot.send_message(update.message.chat.id, "Send me the currency three-letter name.")
+    if context.args:
+        return add_currencies(update, context, " ".join(context.args))
+
+    context.bot.send_message(update.message.chat.id, "Send me the currency three-letter name(s).")
 
     return ADD_CURRENCY
 
 
 def add_currency_answer(update: Update, context: CallbackContext) -> int:
-    currency_name = update.message.text.strip()
-    url = f"https://api.apilayer.com/exchangerates_data/convert?to={currency_name}&from=EUR&amount=1"
+    return add_currencies(update, context, update.message.text)
 
-    headers = {"apikey": currency_exchange_api}
 
-    currency_exchange_rate = run_request("GET", url, request_headers=headers)["result"]
-
-    currencies[currency_name] = currency_exchange_rate
-    save_currencies(currencies, outdir)
+def add_currencies(update: Update, context: CallbackContext, text: str) -> int:
+    """Acknowledges right away and fetches the rates of all currencies in one request in the background."""
+    currency_names = list(dict.fromkeys(text.replace(",", " ").upper().split()))
+    invalid = [name for name in currency_names if len(name) != 3 or not name.isalpha()]
+    if len(currency_names) == 0 or len(invalid) > 0:
+        context.bot.send_message(
+            update.message.chat.id, f"Not a three-letter currency name: {', '.join(invalid)}. Send /add_currency again."
+        )
+        return EXPENSE_DATE
 
-    context.bot.send_message(
-        update.message.chat.id,
-        f"Currency {currency_name} added with " f"exchange rate EUR/{currency_name}: {currency_exchange_rate}",
+    message = context.bot.send_message(
+        update.message.chat.id, f"Fetching the exchange rates of {', '.join(currency_names)}..."
     )
+    context.dispatcher.run_async(report_added_currencies, message, currency_names, context, update=update)
 
     return EXPENSE_DATE
 
 
-def expense_date(update: Update, context: CallbackContext) -> int:
-    """Asks for a date."""
-    dates = [
-        (datetime.date.today() - datetime.timedelta(days=x)).strftime("%d.%m.%Y")
-        for x in range(0, NUMBER_OF_DAYS_TO_SEND)
-    ]
+def report_added_currencies(message: Message, currency_names: List[str], context: CallbackContext) -> None:
+    try:
+        added = rates.add(currency_names)
+    except Exception:
+        logger.exception("Adding the currencies %s failed", currency_names)
+        message.edit_text(f"Couldn't fetch the exchange rates of {', '.join(currency_names)}, try again later.")
+        return
+
+    lines = [f"Currency {name} added with exchange rate EUR/{name}: {rate}" for name, rate in added.items()]
+    lines += [f"Unknown currency {name}." for name in currency_names if name not in added]
+    message.edit_text("\n".join(lines))
 
-    keyboard = [InlineKeyboardButton(d, callback_data=d) for d in dates]
 
-    chunk_size = 3
-    chunks = [keyboard[x : x + chunk_size] for x in range(0, len(keyboard), chunk_size)]
+def expense_date(update: Update, context: CallbackContext) -> int:
+    """Asks for a date."""
+    drafts.pop(update.message.chat.id)
 
-    reply_markup = InlineKeyboardMarkup(chunks)
-    update.message.reply_text("Select date:", reply_markup=reply_markup)
+    update.message.reply_text("Select date:", reply_markup=keyboards.dates())
 
     return EXPENSE_DATE_ANSWER
 
 
 def expense_date_answer(update: Update, context: CallbackContext) -> int:
-    global expense_dates
     query = update.callback_query
 
     # CallbackQueries need to be answered, even if no notification to the user is needed
@@ -106,23 +182,19 @@ def expense_date_answer(update: Update, context: CallbackContext) -> int:
     query.answer()
 
     received_expense_date = query.data
-    query.edit_message_text(text=f"Selected date: {received_expense_date}")
-    expense_dates[query.message.chat.id] = received_expense_date
-
-    keyboard = [InlineKeyboardButton(d, callback_data=d) for d in sorted(list(currencies.keys()))]
+    drafts.update(query.message.chat.id, date=received_expense_date)
 
-    chunk_size = 3
-    chunks = [keyboard[x : x + chunk_size] for x in range(0, len(keyboard), chunk_size)]
-
-    reply_markup = InlineKeyboardMarkup(chunks)
-
-    context.bot.send_message(query.message.chat.id, "What currency?", reply_markup=reply_markup)
+    run_concurrently(
+        functools.partial(query.edit_message_text, text=f"Selected date: {received_expense_date}"),
+        functools.partial(
+            context.bot.send_message, query.message.chat.id, "What currency?", reply_markup=keyboards.currencies()
+        ),
+    )
 
     return EXPENSE_CURRENCY
 
 
 def expense_currency(update: Update, context: CallbackContext) -> int:
-    global expense_currencies
     query = update.callback_query
 
     # CallbackQueries need to be answered, even if no notification to the user is needed
@@ -130,48 +202,26 @@ def expense_currency(update: Update, context: CallbackContext) -> int:
     query.answer()
 
     received_expense_currency = query.data
-    query.edit_message_text(text=f"Selected currency: {received_expense_currency}")
-    expense_currencies[query.message.chat.id] = received_expense_currency
+    drafts.update(query.message.chat.id, currency=received_expense_currency)
 
-    context.bot.send_message(query.message.chat.id, "How much?")
+    run_concurrently(
+        functools.partial(query.edit_message_text, text=f"Selected currency: {received_expense_currency}"),
+        functools.partial(context.bot.send_message, query.message.chat.id, "How much?"),
+    )
 
     return EXPENSE_AMOUNT
 
 
 def expense_amount(update: Update, context: CallbackContext) -> int:
-    global expense_amounts
     amount = float(update.message.text.strip())
-    expense_amounts[update.message.chat.id] = amount
-
-    keyboard = [
-        InlineKeyboardButton(d, callback_data=d)
-        for d in [
-            "Supermarket",
-            "Eating Out",
-            "Drinking",
-            "Busses etc",
-            "Car Rental",
-            "Petrol",
-            "LocalTransport",
-            "Flights",
-            "Hotels",
-            "Trips",
-            "Various",
-        ]
-    ]
-
-    chunk_size = 3
-    chunks = [keyboard[x : x + chunk_size] for x in range(0, len(keyboard), chunk_size)]
-
-    reply_markup = InlineKeyboardMarkup(chunks)
-
-    context.bot.send_message(update.message.chat.id, "What category?", reply_markup=reply_markup)
+    drafts.update(update.message.chat.id, amount=amount)
+
+    context.bot.send_message(update.message.chat.id, "What category?", reply_markup=keyboards.categories())
 
     return EXPENSE_CATEGORY
 
 
 def expense_category(update: Update, context: CallbackContext) -> int:
-    global expense_categories
     query = update.callback_query
 
     # CallbackQueries need to be answered, even if no notification to the user is needed
@@ -179,18 +229,19 @@ def expense_category(update: Update, context: CallbackContext) -> int:
     query.answer()
 
     received_expense_category = query.data
-    query.edit_message_text(text=f"Selected category: {received_expense_category}")
-    expense_categories[query.message.chat.id] = received_expense_category
+    drafts.update(query.message.chat.id, category=received_expense_category)
 
-    context.bot.send_message(query.message.chat.id, "Send a short description:")
+    run_concurrently(
+        functools.partial(query.edit_message_text, text=f"Selected category: {received_expense_category}"),
+        functools.partial(context.bot.send_message, query.message.chat.id, "Send a short description:"),
+    )
 
     return EXPENSE_DESCRIPTION
 
 
 def expense_description(update: Update, context: CallbackContext) -> int:
-    global expense_descriptions
     description = update.message.text.strip()
-    expense_descriptions[update.message.chat.id] = description
+    drafts.update(update.message.chat.id, description=description)
 
     send_info(update.message.chat.id, context)
 
@@ -198,90 +249,253 @@ def expense_description(update: Update, context: CallbackContext) -> int:
 
 
 def send_info(chat_id, context: CallbackContext):
-    global expense_amounts
-    global expense_dates
-    global expense_currencies
-    global expense_categories
-    global expense_descriptions
+    draft = drafts.pop(chat_id)
+    if draft is None or not draft.is_complete():
+        context.bot.send_message(chat_id, "This expense has expired, please start again with /spend.")
+        return
 
-    converted_amount = 0
-    for currency, exchange_rate in currencies.items():
-        if expense_currencies[chat_id] == currency:
-            converted_amount = round(expense_amounts[chat_id] / exchange_rate, 2)
+    record_expense(chat_id, draft, context)
 
-    context.bot.send_message(
-        chat_id,
-        f"{expense_dates[chat_id]}: {expense_amounts[chat_id]} {expense_currencies[chat_id]} "
-        f"({converted_amount} EUR), "
-        f"{expense_categories[chat_id]}, "
-        f"{expense_descriptions[chat_id]}.",
+
+def record_expense(chat_id, draft: DraftExpense, context: CallbackContext) -> None:
+    """Convert a complete expense to EUR, store it and confirm it with a single message."""
+    expense_day = datetime.datetime.strptime(draft.date, DISPLAY_DATE_FORMAT).date()
+    try:
+        converted_amount = round(rates.to_eur(draft.amount, draft.currency, expense_day), 2)
+    except UnknownCurrencyError as e:
+        context.bot.send_message(chat_id, f"{e} Add it with /add_currency and enter the expense again.")
+        return
+
+    run_concurrently(
+        functools.partial(
+            context.bot.send_message,
+            chat_id,
+            f"{draft.date}: {draft.amount} {draft.currency} "
+            f"({converted_amount} EUR), "
+            f"{draft.category}, "
+            f"{draft.description}.",
+        ),
+        functools.partial(
+            storage.append,
+            chat_id,
+            [
+                expense_day,
+                converted_amount,
+                draft.category,
+                draft.description,
+            ],
+        ),
     )
 
-    df = read_csv(outdir, chat_id, df_columns)
-    df = pd.concat(
-        [
-            df,
-            pd.DataFrame(
-                [
-                    [
-                        expense_dates[chat_id],
-                        converted_amount,
-                        expense_categories[chat_id],
-                        expense_descriptions[chat_id],
-                    ]
-                ],
-                columns=df_columns,
-            ),
-        ]
+
+def quick_expense(update: Update, context: CallbackContext) -> int:
+    """Record an expense sent as a single message, e.g. "12.50 USD Eating Out pizza yesterday"."""
+    chat_id = update.message.chat.id
+    tokens = update.message.text.split()
+    # other chatter, e.g. in a group chat, isn't answered
+    if len(tokens) == 0 or not amount_pattern.match(tokens[0]):
+        return EXPENSE_DATE
+    draft = parse_expense(update.message.text, rates.converter, CATEGORIES, datetime.date.today())
+    if draft is None:
+        context.bot.send_message(
+            chat_id,
+            "Send an expense as <amount> [currency] <category> [description] [date], "
+            "e.g. 12.50 USD Eating Out pizza yesterday, or use /spend.",
+        )
+    else:
+        record_expense(chat_id, draft, context)
+
+    return EXPENSE_DATE
+
+
+def import_expenses(update: Update, context: CallbackContext) -> int:
+    """Append all expenses of an uploaded csv to the ledger in one write."""
+    chat_id = update.message.chat.id
+    document = update.message.document
+    if document.file_size is not None and document.file_size > MAX_IMPORT_BYTES:
+        context.bot.send_message(chat_id, f"The file is too big, at most {MAX_IMPORT_BYTES // 1024 // 1024} MB.")
+        return EXPENSE_DATE
+
+    buffer = io.BytesIO()
+    document.get_file().download(out=buffer)
+    buffer.seek(0)
+
+    started = time.perf_counter()
+    try:
+        rows, rejected = read_import(io.TextIOWrapper(buffer, encoding="utf-8-sig", newline=""), rates, CATEGORIES)
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        context.bot.send_message(chat_id, f"Couldn't import {document.file_name}: {e}")
+        return EXPENSE_DATE
+    if len(rows) > 0:
+        storage.append_many(chat_id, rows)
+    seconds = time.perf_counter() - started
+
+    lines = [f"Imported {len(rows)} expenses in {seconds:.2f} s ({len(rows) / max(seconds, 1e-6):.0f} rows/s)."]
+    if len(rejected) > 0:
+        lines.append(f"Rejected {len(rejected)} rows:")
+        lines += [f"line {line}: {reason}" for line, reason in rejected[:10]]
+        if len(rejected) > 10:
+            lines.append("...")
+    context.bot.send_message(chat_id, "\n".join(lines))
+
+    return EXPENSE_DATE
+
+
+def sorted_expenses(chat_id) -> Ledger:
+    """The ledger ordered by date. Rows are stored in entry order, which usually already is date order."""
+    return storage.read(chat_id).sorted_by_date()
+
+
+def expense_chunks(ledger: Ledger) -> Iterator[str]:
+    """Render the expenses as csv lines, in chunks that fit into one Telegram message."""
+    return chunk_lines(
+        f"{date.strftime(DISPLAY_DATE_FORMAT)},{amount},{category},{description}"
+        for date, amount, category, description in ledger
     )
-    write_csv(df, outdir, chat_id)
+
+
+def expenses_page_markup(page: int, has_next: bool) -> InlineKeyboardMarkup:
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("Previous page", callback_data=f"expenses_page:{page - 1}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next page", callback_data=f"expenses_page:{page + 1}"))
+    return InlineKeyboardMarkup([buttons])
 
 
 def send_all_expenses(update: Update, context: CallbackContext) -> int:
-    df = read_csv(outdir, update.message.chat.id, df_columns)
-    df["sorting_date"] = pd.to_datetime(df["date"], format="%d.%m.%Y")
-    df.sort_values(by=["sorting_date"], inplace=True)
+    chat_id = update.message.chat.id
+    ledger = sorted_expenses(chat_id)
 
-    message = ""
-    for c in df.itertuples():
-        if len(message) > 0:
-            message = message + "\n"
-        message = message + f"{c.date},{c.amount},{c.category},{c.description}"
+    if len(ledger) == 0:
+        context.bot.send_message(chat_id, "No expenses yet!")
+    else:
+        totals = storage.totals(chat_id)
+        chunks = expense_chunks(ledger)
+        if paginate_expenses:
+            first_pages = list(itertools.islice(chunks, 2))
+            context.bot.send_message(
+                chat_id, first_pages[0], reply_markup=expenses_page_markup(0, len(first_pages) > 1)
+            )
+        else:
+            for chunk in chunks:
+                context.bot.send_message(chat_id, chunk)
+        context.bot.send_message(chat_id, f"Sum: {totals['total']}")
+        context.bot.send_message(chat_id, f"Spent today: {totals['days'].get(datetime.date.today().isoformat(), 0.0)}")
 
-    if len(message) == 0:
-        context.bot.send_message(update.message.chat.id, "No expenses yet!")
+    return EXPENSE_DATE
+
+
+def expenses_page(update: Update, context: CallbackContext) -> None:
+    """Show another page of /send_all_expenses, rendering only up to the requested page."""
+    query = update.callback_query
+    query.answer()
+
+    page = int(query.data.split(":")[1])
+    pages = list(itertools.islice(expense_chunks(sorted_expenses(query.message.chat.id)), page, page + 2))
+    if len(pages) == 0:
+        query.edit_message_text(text="No expenses yet!")
     else:
-        context.bot.send_message(update.message.chat.id, message)
-        context.bot.send_message(update.message.chat.id, f"Sum: {round(df['amount'].sum(), 2)}")
-        context.bot.send_message(
-            update.message.chat.id,
-            f"Spent today: {round(df[df.date == datetime.date.today().strftime('%d.%m.%Y')]['amount'].sum(), 2)}",
-        )
+        query.edit_message_text(text=pages[0], reply_markup=expenses_page_markup(page, len(pages) > 1))
+
+    # the page buttons can be pressed in any conversation state, keep them away from the ConversationHandler
+    raise DispatcherHandlerStop()
+
+
+def summary(update: Update, context: CallbackContext) -> int:
+    """Answer from the running totals without reading the ledger, /summary <from> [<to>] sums a date range."""
+    chat_id = update.message.chat.id
+    if context.args:
+        return summary_between(chat_id, context)
+
+    totals = storage.totals(chat_id)
+    if totals["count"] == 0:
+        context.bot.send_message(chat_id, "No expenses yet!")
+        return EXPENSE_DATE
+
+    today = datetime.date.today().isoformat()
+    categories = "\n".join(f"{category}: {amount}" for category, amount in sorted(totals["categories"].items()))
+    context.bot.send_message(
+        chat_id,
+        f"Entries: {totals['count']}\n"
+        f"Sum: {totals['total']}\n"
+        f"Spent today: {totals['days'].get(today, 0.0)}\n"
+        f"Spent this month: {totals['months'].get(today[:7], 0.0)}\n\n"
+        f"{categories}",
+    )
 
     return EXPENSE_DATE
 
 
-def delete_last_entry(update: Update, context: CallbackContext) -> int:
+def summary_between(chat_id, context: CallbackContext) -> int:
+    today = datetime.date.today()
+    days = [parse_date(arg, today) for arg in context.args]
+    if len(days) > 2 or None in days:
+        context.bot.send_message(chat_id, "Send /summary <from> [<to>], e.g. /summary 01.03 31.03.")
+        return EXPENSE_DATE
+
+    start, end = days[0], days[-1] if len(days) > 1 else today
+    total = round(storage.sum_between(chat_id, start, end), 2)
+    context.bot.send_message(
+        chat_id, f"Spent from {start.strftime(DISPLAY_DATE_FORMAT)} to {end.strftime(DISPLAY_DATE_FORMAT)}: {total}"
+    )
+
+    return EXPENSE_DATE
+
+
+def export(update: Update, context: CallbackContext) -> int:
+    """Send the whole ledger as one document: /export [csv|gzip|parquet]."""
     chat_id = update.message.chat.id
-    df = read_csv(outdir, chat_id, df_columns)
+    file_format = context.args[0].lower() if context.args else "csv"
+    if file_format not in export_formats:
+        context.bot.send_message(chat_id, f"Unknown format, use one of: {', '.join(export_formats)}.")
+        return EXPENSE_DATE
 
-    df = df.drop([df.iloc[-1].name])
-    write_csv(df, outdir, chat_id)
+    try:
+        document = export_rows(storage.iter_rows(chat_id), df_columns, file_format)
+    except ImportError:
+        context.bot.send_message(chat_id, "Parquet export is not available on this server.")
+        return EXPENSE_DATE
+
+    context.bot.send_document(chat_id, document, filename=f"expenses{export_formats[file_format]}")
 
-    context.bot.send_message(update.message.chat.id, "Last entry deleted.")
+    return EXPENSE_DATE
+
+
+def delete_last_entry(update: Update, context: CallbackContext) -> int:
+    chat_id = update.message.chat.id
+    if storage.delete_last(chat_id) is None:
+        context.bot.send_message(update.message.chat.id, "No expenses yet!")
+    else:
+        context.bot.send_message(update.message.chat.id, "Last entry deleted.")
 
     return EXPENSE_DATE
 
 
 def clear_all(update: Update, context: CallbackContext) -> int:
     chat_id = update.message.chat.id
-    os.remove(os.path.join(outdir, f"{chat_id}.csv"))
+    storage.clear(chat_id)
 
     context.bot.send_message(update.message.chat.id, "Removed all entries.")
 
     return EXPENSE_DATE
 
 
+def cache_stats(update: Update, context: CallbackContext) -> int:
+    """Send the ledger cache counters, only to the developer chat."""
+    if str(update.message.chat.id) != str(developer_chat_id):
+        return EXPENSE_DATE
+
+    ledger_cache = find_layer(storage, LedgerCache)
+    if ledger_cache is not None:
+        message = ", ".join(f"{key}: {value}" for key, value in ledger_cache.stats().items())
+    else:
+        message = "The ledger cache is disabled."
+    context.bot.send_message(update.message.chat.id, message)
+
+    return EXPENSE_DATE
+
+
 def error_handler(update: object, context: CallbackContext) -> int:
     """Log the error and send a telegram message to notify the developer."""
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
@@ -303,6 +517,7 @@ def error_handler(update: object, context: CallbackContext) -> int:
 
 def cancel(update: Update, context: CallbackContext) -> int:
     """Cancels and ends the conversation."""
+    drafts.pop(update.message.chat.id)
 
     context.bot.send_message(update.message.chat.id, "Current operation cancelled.")
 
@@ -311,25 +526,53 @@ def cancel(update: Update, context: CallbackContext) -> int:
 
 def main() -> None:
     """Setup and run the bot."""
+    for path in remove_temp_files(outdir):
+        logger.info("Removed %s left behind by an interrupted write", path)
+    storage.recover()
+    storage.upgrade()
+    # ledgers of older versions are moved into the sharded layout while the bot is already running
+    threading.Thread(target=shard_ledgers, args=(outdir,), name="shard-ledgers", daemon=True).start()
+
     # Create the Updater and pass it your bot's token.
-    updater = Updater(bot_token)
+    persistence = None
+    if persist_conversations:
+        persistence = ConversationPersistence(
+            os.path.join(outdir, "conversations.pickle"),
+            store_user_data=False,
+            store_chat_data=False,
+            store_bot_data=False,
+        )
+    if parallel_runtime:
+        updater = make_chat_pool_updater(bot_token, workers, persistence=persistence)
+    else:
+        updater = Updater(bot_token, persistence=persistence)
 
     conv_handler = ConversationHandler(
         entry_points=[
             CommandHandler("spend", expense_date),
             CommandHandler("start", start),
             CommandHandler("send_all_expenses", send_all_expenses),
+            CommandHandler("export", export),
+            CommandHandler("summary", summary),
             CommandHandler("delete_last_entry", delete_last_entry),
             CommandHandler("clear_all", clear_all),
             CommandHandler("add_currency", add_currency),
+            CommandHandler("cache_stats", cache_stats),
+            MessageHandler(Filters.text & ~Filters.command, quick_expense),
+            MessageHandler(Filters.document.file_extension("csv"), import_expenses),
         ],
         states={
             EXPENSE_DATE: [
                 CommandHandler("spend", expense_date),
                 CommandHandler("send_all_expenses", send_all_expenses),
+                CommandHandler("export", export),
+                CommandHandler("summary", summary),
                 CommandHandler("delete_last_entry", delete_last_entry),
                 CommandHandler("clear_all", clear_all),
                 CommandHandler("add_currency", add_currency),
+                CommandHandler("cache_stats", cache_stats),
+                MessageHandler(Filters.text & ~Filters.command, quick_expense),
+                MessageHandler(Filters.document.file_extension("csv"), import_expenses),
             ],
             EXPENSE_DATE_ANSWER: [CallbackQueryHandler(expense_date_answer)],
             EXPENSE_CURRENCY: [CallbackQueryHandler(expense_currency)],
@@ -339,18 +582,32 @@ def main() -> None:
             ADD_CURRENCY: [MessageHandler(Filters.text & ~Filters.command, add_currency_answer)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="expense",
+        persistent=persist_conversations,
     )
 
+    updater.dispatcher.add_handler(CallbackQueryHandler(expenses_page, pattern=r"^expenses_page:\d+$"), group=-1)
     updater.dispatcher.add_handler(conv_handler)
 
     updater.dispatcher.add_error_handler(error_handler)
 
-    # Start the Bot
-    updater.start_polling()
+    rates.schedule(updater.job_queue)
+    drafts.schedule(updater.job_queue)
+
+    if "webhook" in config:
+        # Receive updates pushed by Telegram until the process receives SIGINT or SIGTERM
+        run_webhook(updater, config["webhook"])
+    else:
+        # Start the Bot
+        updater.start_polling()
+
+        # Run the bot until the user presses Ctrl-C or the process receives SIGINT,
+        # SIGTERM or SIGABRT
+        updater.idle()
 
-    # Run the bot until the user presses Ctrl-C or the process receives SIGINT,
-    # SIGTERM or SIGABRT
-    updater.idle()
+    # write the expenses that are still buffered, and the drafts of expenses that are being entered
+    storage.close()
+    drafts.flush()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,146 @@
+import csv
+import datetime
+import itertools
+import math
+from typing import IO, Iterator, List, Sequence, Tuple
+
+from rates import RateService
+from tools import DISPLAY_DATE_FORMAT
+
+# columns an uploaded csv may have, only date and amount are required
+import_columns = ["date", "amount", "currency", "category", "description"]
+default_category = "Various"
+
+
+def parse_import_date(value: str) -> datetime.date:
+    value = value.strip()
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.strptime(value, DISPLAY_DATE_FORMAT).date()
+    except ValueError:
+        raise ValueError(f"invalid date {value!r}") from None
+
+
+def parse_import_amount(value: str) -> float:
+    """Amounts like 12.50, 12,50 or 1.234,56 as bank exports write them."""
+    number = value.strip().replace(" ", "")
+    if "," in number:
+        # a comma after the last dot is the decimal separator, otherwise commas separate thousands
+        number = number.replace(".", "").replace(",", ".") if number.rfind(",") > number.rfind(".") else number
+        number = number.replace(",", "")
+    try:
+        amount = float(number)
+    except ValueError:
+        raise ValueError(f"invalid amount {value!r}") from None
+    if not math.isfinite(amount):
+        raise ValueError(f"invalid amount {value!r}")
+    return amount
+
+
+def import_category(value: str, description: str, categories: Sequence[str]) -> Tuple[str, str]:
+    """The category and description of an imported row.
+
+    Categories are matched case-insensitively against the bot's categories. Others, e.g. a bank's own labels,
+    become default_category and are kept at the start of the description.
+
+    >>> import_category("eating out", "pizza", ["Eating Out", "Various"])
+    ('Eating Out', 'pizza')
+    >>> import_category("Groceries", "milk", ["Eating Out", "Various"])
+    ('Various', 'Groceries: milk')
+    """
+    if value == "":
+        return default_category, description
+    for category in categories:
+        if category.lower() == value.lower():
+            return category, description
+    return default_category, f"{value}: {description}" if description else value
+
+
+def read_import_chunks(
+    file: IO[str], rates: RateService, categories: Sequence[str], chunk_size: int = 5000
+) -> Iterator[Tuple[List[List], List[Tuple[int, str]]]]:
+    """Stream a csv with a header row and yield (valid rows, rejected rows) per chunk of chunk_size lines.
+
+    Valid rows are [date, amount, currency, category, description], rejected rows (line number, reason).
+    Rows with more values than the header, e.g. an unquoted decimal comma, and negative amounts, which
+    bank exports use for debits, are rejected rather than guessed. Categories that aren't one of the given
+    ones are replaced by default_category, see import_category. The delimiter (comma, semicolon or tab) is
+    detected from the start of the file. Raises ValueError if the header lacks a date or an amount column.
+    """
+    sample = file.read(8192)
+    file.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(file, dialect)
+
+    header = [name.strip().lower() for name in next(reader, [])]
+    if "date" not in header or "amount" not in header:
+        raise ValueError("The csv needs a header row with at least a date and an amount column.")
+    columns = {name: header.index(name) for name in import_columns if name in header}
+
+    def field(record: List[str], name: str, default: str) -> str:
+        index = columns.get(name)
+        value = record[index].strip() if index is not None and index < len(record) else ""
+        return value or default
+
+    while True:
+        rows = []
+        rejected = []
+        records = 0
+        for record in itertools.islice(reader, chunk_size):
+            records += 1
+            if not any(value.strip() for value in record):
+                continue
+            try:
+                if any(value.strip() for value in record[len(header) :]):
+                    raise ValueError(f"{len(record)} values but {len(header)} columns")
+                date = parse_import_date(field(record, "date", ""))
+                amount = parse_import_amount(field(record, "amount", ""))
+                if amount < 0:
+                    raise ValueError(f"negative amount {amount}, expenses have to be positive")
+                currency = field(record, "currency", "EUR").upper()
+                if currency not in rates.converter:
+                    raise ValueError(f"unknown currency {currency}")
+            except ValueError as e:
+                rejected.append((reader.line_num, str(e)))
+                continue
+            category, description = import_category(
+                field(record, "category", ""), field(record, "description", ""), categories
+            )
+            rows.append([date, amount, currency, category, description])
+        if records == 0:
+            return
+        yield rows, rejected
+
+
+def convert_chunk(rows: List[List], rates: RateService) -> List[List]:
+    """Convert parsed rows to ledger rows in EUR, with one vectorized multiplication per chunk.
+
+    The factor of every (currency, day) pair is looked up once, using the rate of that day if it is known.
+    """
+    import numpy as np
+
+    keys = [(row[2], row[0]) for row in rows]
+    factors = {key: rates.to_eur(1.0, *key) for key in set(keys)}
+    amounts = np.fromiter((row[1] for row in rows), dtype=np.float64, count=len(rows))
+    factor_column = np.fromiter((factors[key] for key in keys), dtype=np.float64, count=len(rows))
+    converted = np.round(amounts * factor_column, 2).tolist()
+    return [[row[0], amount, row[3], row[4]] for row, amount in zip(rows, converted)]
+
+
+def read_import(
+    file: IO[str], rates: RateService, categories: Sequence[str], chunk_size: int = 5000
+) -> Tuple[List[List], List[Tuple[int, str]]]:
+    """All valid rows of an uploaded csv as ledger rows in EUR, and the rejected rows."""
+    ledger_rows = []
+    rejected = []
+    for rows, chunk_rejected in read_import_chunks(file, rates, categories, chunk_size):
+        if len(rows) > 0:
+            ledger_rows.extend(convert_chunk(rows, rates))
+        rejected.extend(chunk_rejected)
+    return ledger_rows, rejected
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the bot runs from this directory and imports its modules without the package name, so do the tests
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -0,0 +1,79 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from typing import Callable
+
+from telegram import Update
+from telegram.ext import BasePersistence, Dispatcher, ExtBot, JobQueue, Updater
+from telegram.utils.request import Request
+
+logger = logging.getLogger(__name__)
+
+
+class ChatWorkerPool:
+    """Runs updates of different chats in parallel and updates of the same chat one after another, in order.
+
+    Every chat with pending updates has a queue which a single pool thread drains, the queue is dropped as soon
+    as it is empty so idle chats take no memory.
+    """
+
+    def __init__(self, process: Callable, workers: int):
+        self.process = process
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chat")
+        self.lock = threading.Lock()
+        self.pending = dict()
+
+    def submit(self, chat_id, update) -> None:
+        with self.lock:
+            queue = self.pending.get(chat_id)
+            if queue is not None:
+                queue.append(update)
+                return
+            self.pending[chat_id] = deque([update])
+        self.executor.submit(self._drain, chat_id)
+
+    def _drain(self, chat_id) -> None:
+        while True:
+            with self.lock:
+                queue = self.pending[chat_id]
+                if len(queue) == 0:
+                    del self.pending[chat_id]
+                    return
+                update = queue.popleft()
+            try:
+                self.process(update)
+            except Exception:
+                logger.exception("Processing an update of chat %s failed", chat_id)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
+
+
+class ChatSerialDispatcher(Dispatcher):
+    """Dispatcher handing updates to a ChatWorkerPool instead of processing them one at a time."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chat_pool = ChatWorkerPool(super().process_update, self.workers)
+
+    def process_update(self, update: object) -> None:
+        if isinstance(update, Update) and update.effective_chat is not None:
+            self.chat_pool.submit(update.effective_chat.id, update)
+        else:
+            super().process_update(update)
+
+    def stop(self) -> None:
+        super().stop()
+        self.chat_pool.shutdown()
+
+
+def make_chat_pool_updater(bot_token: str, workers: int, persistence: BasePersistence = None) -> Updater:
+    """Create an Updater whose dispatcher processes the updates of up to `workers` chats at the same time."""
+    # a connection for every chat worker and every run_async worker, plus the updater, job queue and main thread
+    bot = ExtBot(bot_token, request=Request(con_pool_size=2 * workers + 4))
+    job_queue = JobQueue()
+    dispatcher = ChatSerialDispatcher(bot, Queue(), workers=workers, job_queue=job_queue, persistence=persistence)
+    job_queue.set_dispatcher(dispatcher)
+    return Updater(dispatcher=dispatcher, workers=None)
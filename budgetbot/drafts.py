@@ -0,0 +1,151 @@
+import json
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from telegram.ext import JobQueue, PicklePersistence
+
+from tools import atomic_write
+
+logger = logging.getLogger(__name__)
+
+
+class DraftExpense:
+    """The answers a chat has given so far in the /spend conversation."""
+
+    __slots__ = ("date", "currency", "amount", "category", "description", "updated")
+
+    def __init__(self, date=None, currency=None, amount=None, category=None, description=None, updated=None):
+        self.date = date
+        self.currency = currency
+        self.amount = amount
+        self.category = category
+        self.description = description
+        self.updated = time.time() if updated is None else updated
+
+    def is_complete(self) -> bool:
+        return None not in (self.date, self.currency, self.amount, self.category, self.description)
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class DraftStore:
+    """Draft expenses per chat, bounded in size and expiring after ttl seconds without an answer.
+
+    The least recently updated drafts are dropped once there are more than max_size. With a path the
+    drafts are loaded from that json file on startup and written to it by flush(), which schedule() calls
+    every few seconds if anything changed and which is called again on shutdown. So expenses that are being
+    entered survive a restart, and after a crash only the answers of the last seconds are lost.
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: float = 24 * 60 * 60, path: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.lock = threading.Lock()
+        self.drafts = OrderedDict()
+        # whether the drafts changed since they were last written
+        self.dirty = False
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as file:
+                    for chat_id, fields in json.load(file).items():
+                        self.drafts[int(chat_id)] = DraftExpense(**fields)
+            except (ValueError, TypeError, AttributeError):
+                logger.exception("Could not load the drafts from %s, starting without them", path)
+                self.drafts.clear()
+            self._expire()
+
+    def _expire(self) -> None:
+        now = time.time()
+        while len(self.drafts) > 0:
+            chat_id, draft = next(iter(self.drafts.items()))
+            if len(self.drafts) <= self.max_size and now - draft.updated < self.ttl:
+                break
+            del self.drafts[chat_id]
+
+    def flush(self) -> None:
+        """Write the drafts to the json file if they changed since the last write."""
+        with self.lock:
+            if self.path is None or not self.dirty:
+                return
+            self.dirty = False
+            # drafts are short-lived and an unreadable file is ignored on startup, so they aren't fsync'd
+            with atomic_write(self.path, durable=False) as outfile:
+                json.dump({chat_id: draft.to_dict() for chat_id, draft in self.drafts.items()}, outfile)
+
+    def schedule(self, job_queue: JobQueue, interval: float = 10) -> None:
+        """Write changed drafts every interval seconds."""
+        job_queue.run_repeating(lambda context: self.flush(), interval=interval, first=interval, name="save_drafts")
+
+    def update(self, chat_id, **fields) -> DraftExpense:
+        """Set answers of the chat's draft, starting a new draft if there is none."""
+        with self.lock:
+            draft = self.drafts.pop(chat_id, None) or DraftExpense()
+            for field, value in fields.items():
+                setattr(draft, field, value)
+            draft.updated = time.time()
+            self.drafts[chat_id] = draft
+            self._expire()
+            self.dirty = True
+            return draft
+
+    def pop(self, chat_id) -> Optional[DraftExpense]:
+        with self.lock:
+            self._expire()
+            draft = self.drafts.pop(chat_id, None)
+            if draft is not None:
+                self.dirty = True
+            return draft
+
+    def __len__(self) -> int:
+        return len(self.drafts)
+
+
+class ConversationPersistence(PicklePersistence):
+    """PicklePersistence that replaces its file atomically instead of rewriting it in place.
+
+    The conversation states are written after every step, a crash during such a write would otherwise
+    leave a torn pickle behind. A file that can't be loaded anyway is logged and dropped, so the bot
+    still starts, only without the conversation states.
+
+    The chat workers of the parallel runtime update the states of different chats at the same time,
+    so updates and writes are serialized.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+
+    def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        with self.lock:
+            super().update_conversation(name, key, new_state)
+
+    def flush(self) -> None:
+        with self.lock:
+            super().flush()
+
+    def _load_singlefile(self) -> None:
+        try:
+            super()._load_singlefile()
+        except TypeError:
+            logger.exception("Could not load the conversations from %s, starting without them", self.filename)
+            os.remove(self.filename)
+            super()._load_singlefile()
+
+    def _dump_singlefile(self) -> None:
+        data = {
+            "conversations": self.conversations,
+            "user_data": self.user_data,
+            "chat_data": self.chat_data,
+            "bot_data": self.bot_data,
+            "callback_data": self.callback_data,
+        }
+        # like the drafts the states are short-lived and an unreadable file is dropped, so they aren't fsync'd
+        with atomic_write(self.filename, "wb", durable=False) as outfile:
+            pickle.dump(data, outfile)
@@ -0,0 +1,61 @@
+import datetime
+from typing import List, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from rates import RateService
+from tools import DISPLAY_DATE_FORMAT
+
+
+class SharedKeyboard(InlineKeyboardMarkup):
+    """An inline keyboard that is sent unchanged to many chats, so it is serialized only once."""
+
+    __slots__ = ("_json",)
+
+    def __init__(self, labels: List[str], chunk_size: int = 3):
+        buttons = [InlineKeyboardButton(label, callback_data=label) for label in labels]
+        super().__init__([buttons[x : x + chunk_size] for x in range(0, len(buttons), chunk_size)])
+        self._json = super().to_json()
+
+    def to_json(self) -> str:
+        return self._json
+
+
+class KeyboardCache:
+    """The keyboards of the /spend conversation, built once and shared by all chats.
+
+    The date keyboard is rebuilt when the day changes, the currency keyboard when the rate table
+    is replaced (a currency was added or the rates were refreshed). A rebuild racing another one
+    only builds the same keyboard twice.
+    """
+
+    def __init__(self, rates: RateService, number_of_days: int, categories: List[str]):
+        self.rates = rates
+        self.number_of_days = number_of_days
+        self._dates: Tuple[datetime.date, SharedKeyboard] = (None, None)
+        self._currencies: Tuple[object, SharedKeyboard] = (None, None)
+        self._categories = SharedKeyboard(categories)
+
+    def dates(self) -> SharedKeyboard:
+        today = datetime.date.today()
+        day, keyboard = self._dates
+        if day != today:
+            keyboard = SharedKeyboard(
+                [
+                    (today - datetime.timedelta(days=x)).strftime(DISPLAY_DATE_FORMAT)
+                    for x in range(0, self.number_of_days)
+                ]
+            )
+            self._dates = (today, keyboard)
+        return keyboard
+
+    def currencies(self) -> SharedKeyboard:
+        converter = self.rates.converter
+        source, keyboard = self._currencies
+        if source is not converter:
+            keyboard = SharedKeyboard(sorted(converter.rates))
+            self._currencies = (converter, keyboard)
+        return keyboard
+
+    def categories(self) -> SharedKeyboard:
+        return self._categories
@@ -0,0 +1,184 @@
+import bisect
+import datetime
+import sys
+from array import array
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+class Ledger:
+    """The expenses of one chat in compact typed columns.
+
+    Dates are kept as int32 day numbers (date.toordinal()), amounts as float64 and categories as int32 ids
+    into a per-ledger table of interned names. Descriptions are stored UTF-8 encoded back to back in one
+    buffer with their end offsets in a uint32 column, so a row takes a few dozen bytes instead of a tuple of
+    Python objects. Appending and popping the last row are amortised O(1).
+
+    Rows are usually entered in date order, which is tracked so that date ranges of sorted ledgers are
+    found by binary search.
+    """
+
+    __slots__ = (
+        "days",
+        "amounts",
+        "category_ids",
+        "description_ends",
+        "description_data",
+        "categories",
+        "_ids",
+        "_sorted",
+    )
+
+    def __init__(self):
+        self.days = array("i")
+        self.amounts = array("d")
+        self.category_ids = array("i")
+        self.description_ends = array("I")
+        self.description_data = bytearray()
+        self.categories: List[str] = []
+        self._ids: Dict[str, int] = {}
+        self._sorted = True
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[List]) -> "Ledger":
+        ledger = cls()
+        ledger.extend(rows)
+        return ledger
+
+    def _category_id(self, category: str) -> int:
+        category_id = self._ids.get(category)
+        if category_id is None:
+            category_id = len(self.categories)
+            self.categories.append(sys.intern(category))
+            self._ids[self.categories[-1]] = category_id
+        return category_id
+
+    def append(self, row: List) -> None:
+        date, amount, category, description = row
+        day = date.toordinal()
+        if self._sorted and len(self.days) > 0 and day < self.days[-1]:
+            self._sorted = False
+        self.days.append(day)
+        self.amounts.append(float(amount))
+        self.category_ids.append(self._category_id(category))
+        self.description_data += description.encode("UTF-8")
+        self.description_ends.append(len(self.description_data))
+
+    def extend(self, rows: Iterable[List]) -> None:
+        for row in rows:
+            self.append(row)
+
+    def _description_bytes(self, index: int) -> bytearray:
+        start = self.description_ends[index - 1] if index > 0 else 0
+        return self.description_data[start : self.description_ends[index]]
+
+    def _description(self, index: int) -> str:
+        return self._description_bytes(index).decode("UTF-8")
+
+    def row(self, index: int) -> List:
+        """The row at index as [date, amount, category, description]."""
+        if index < 0:
+            index += len(self)
+        return [
+            datetime.date.fromordinal(self.days[index]),
+            self.amounts[index],
+            self.categories[self.category_ids[index]],
+            self._description(index),
+        ]
+
+    def pop(self) -> Optional[List]:
+        """Remove the last row and return it, or None if the ledger is empty."""
+        if len(self) == 0:
+            return None
+        row = self.row(-1)
+        self.days.pop()
+        self.amounts.pop()
+        self.category_ids.pop()
+        self.description_ends.pop()
+        del self.description_data[self.description_ends[-1] if len(self.description_ends) > 0 else 0 :]
+        return row
+
+    def __len__(self) -> int:
+        return len(self.days)
+
+    def __iter__(self) -> Iterator[List]:
+        return (self.row(index) for index in range(len(self)))
+
+    def _in_range(self, start: Optional[datetime.date], end: Optional[datetime.date]) -> Iterable[int]:
+        first = -sys.maxsize if start is None else start.toordinal()
+        last = sys.maxsize if end is None else end.toordinal()
+        if self.is_sorted():
+            return range(bisect.bisect_left(self.days, first), bisect.bisect_right(self.days, last))
+        return (index for index, day in enumerate(self.days) if first <= day <= last)
+
+    def sum(self, start: Optional[datetime.date] = None, end: Optional[datetime.date] = None) -> float:
+        """Total amount of the rows from start to end (inclusive), of all rows without bounds."""
+        if start is None and end is None:
+            return sum(self.amounts)
+        indices = self._in_range(start, end)
+        if isinstance(indices, range):
+            return sum(self.amounts[indices.start : indices.stop])
+        amounts = self.amounts
+        return sum(amounts[index] for index in indices)
+
+    def filter(
+        self,
+        start: Optional[datetime.date] = None,
+        end: Optional[datetime.date] = None,
+        category: Optional[str] = None,
+    ) -> "Ledger":
+        """A new ledger with the rows from start to end (inclusive) and of the given category, in order."""
+        indices = self._in_range(start, end)
+        if category is not None:
+            category_id = self._ids.get(category)
+            indices = (index for index in indices if self.category_ids[index] == category_id)
+        return self._take(indices)
+
+    def is_sorted(self) -> bool:
+        if not self._sorted:
+            # popping rows may have restored the order
+            days = self.days
+            self._sorted = all(days[index] <= days[index + 1] for index in range(len(days) - 1))
+        return self._sorted
+
+    def sorted_by_date(self) -> "Ledger":
+        """The rows ordered by date, keeping the entry order within a day. Returns self if already sorted."""
+        if self.is_sorted():
+            return self
+        ledger = self._take(sorted(range(len(self)), key=self.days.__getitem__))
+        ledger._sorted = True
+        return ledger
+
+    def _take(self, indices: Iterable[int]) -> "Ledger":
+        ledger = Ledger()
+        # checked again when needed
+        ledger._sorted = self._sorted
+        for index in indices:
+            ledger.days.append(self.days[index])
+            ledger.amounts.append(self.amounts[index])
+            ledger.category_ids.append(ledger._category_id(self.categories[self.category_ids[index]]))
+            ledger.description_data += self._description_bytes(index)
+            ledger.description_ends.append(len(ledger.description_data))
+        return ledger
+
+    def nbytes(self) -> int:
+        """Approximate memory used by the columns, for cache accounting."""
+        columns = (self.days, self.amounts, self.category_ids, self.description_ends)
+        column_bytes = sum(column.buffer_info()[1] * column.itemsize for column in columns)
+        category_bytes = sum(sys.getsizeof(category) for category in self.categories)
+        return column_bytes + len(self.description_data) + category_bytes
+
+    def to_frame(self, columns: List[str]) -> "pd.DataFrame":
+        """Export adapter to a pandas DataFrame, for analysis outside the bot. pandas is an optional dependency."""
+        import pandas as pd
+
+        return pd.DataFrame(
+            {
+                columns[0]: pd.to_datetime([datetime.date.fromordinal(day) for day in self.days]),
+                columns[1]: pd.Series(self.amounts, dtype="float64"),
+                columns[2]: pd.Categorical.from_codes(self.category_ids, self.categories),
+                columns[3]: [self._description(index) for index in range(len(self))],
+            }
+        )
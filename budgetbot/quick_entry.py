@@ -0,0 +1,95 @@
+import datetime
+import re
+from typing import Container, List, Optional
+
+from drafts import DraftExpense
+from tools import DISPLAY_DATE_FORMAT
+
+amount_pattern = re.compile(r"^\d+(?:[.,]\d{1,2})?$")
+# only the bot's own date format, so that e.g. "1.5" in a description isn't taken for a date
+date_pattern = re.compile(r"^\d{2}\.\d{2}(\.\d{4})?$")
+relative_days = {"today": 0, "yesterday": 1}
+# how far back a dd.mm in the future may be moved to last year, e.g. 31.12 sent in early January
+YEAR_WRAP_DAYS = 31
+
+
+def _strptime(token: str) -> Optional[datetime.date]:
+    try:
+        return datetime.datetime.strptime(token, DISPLAY_DATE_FORMAT).date()
+    except ValueError:
+        return None
+
+
+def parse_date(token: str, today: datetime.date) -> Optional[datetime.date]:
+    """today, yesterday, 31.12.2024 or 31.12 (this year), None if the token isn't a date.
+
+    A dd.mm after today is last year's if that is at most YEAR_WRAP_DAYS ago, otherwise it stays in the future.
+
+    >>> parse_date("31.12", datetime.date(2025, 1, 3))
+    datetime.date(2024, 12, 31)
+    >>> parse_date("1.5", datetime.date(2025, 1, 3)) is None
+    True
+    """
+    token = token.lower()
+    if token in relative_days:
+        return today - datetime.timedelta(days=relative_days[token])
+    if not date_pattern.match(token):
+        return None
+    if len(token) == len("dd.mm"):
+        date = _strptime(f"{token}.{today.year}")
+        if date is not None and date > today:
+            last_year = _strptime(f"{token}.{today.year - 1}")
+            if last_year is not None and (today - last_year).days <= YEAR_WRAP_DAYS:
+                return last_year
+        return date
+    return _strptime(token)
+
+
+def parse_expense(
+    text: str, currencies: Container[str], categories: List[str], today: datetime.date
+) -> Optional[DraftExpense]:
+    """Read a whole expense from one message: <amount> [currency] <category> [description] [date].
+
+    For example "12.50 USD Eating Out pizza yesterday". The currency defaults to EUR and the date to
+    today, categories are matched case-insensitively. Returns None if the text isn't an expense.
+    """
+    tokens = text.split()
+    if len(tokens) < 2 or not amount_pattern.match(tokens[0]):
+        return None
+    amount = float(tokens[0].replace(",", "."))
+    tokens = tokens[1:]
+
+    currency = "EUR"
+    # an upper-case three-letter code is taken as a currency even if it is unknown, so that it can be reported
+    if tokens[0].upper() in currencies or (len(tokens[0]) == 3 and tokens[0].isalpha() and tokens[0].isupper()):
+        currency = tokens[0].upper()
+        tokens = tokens[1:]
+
+    lowered = [token.lower() for token in tokens]
+    category = None
+    # the longest matching name wins, in case one category name starts with another
+    for name in sorted(categories, key=len, reverse=True):
+        words = name.lower().split()
+        if lowered[: len(words)] == words:
+            category = name
+            tokens = tokens[len(words) :]
+            break
+    if category is None:
+        return None
+
+    date = today
+    if len(tokens) > 0:
+        parsed = parse_date(tokens[-1], today)
+        if parsed is not None:
+            date = parsed
+            tokens = tokens[:-1]
+    if date > today:
+        return None
+
+    return DraftExpense(
+        date=date.strftime(DISPLAY_DATE_FORMAT),
+        currency=currency,
+        amount=amount,
+        category=category,
+        description=" ".join(tokens),
+    )
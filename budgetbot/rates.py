@@ -0,0 +1,218 @@
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+from telegram.ext import JobQueue
+
+from tools import read_currencies, run_request, save_currencies
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownCurrencyError(ValueError):
+    pass
+
+
+class CurrencyConverter:
+    """Converts amounts between EUR and the currencies of one rate table with a single dict lookup.
+
+    The table maps a currency to its EUR rate (units of the currency per EUR), the inverse rates are
+    computed once so conversions to EUR are a multiplication.
+    """
+
+    __slots__ = ("rates", "inverse_rates")
+
+    def __init__(self, rates: Dict[str, float]):
+        self.rates = dict(rates)
+        self.inverse_rates = {currency: 1 / rate for currency, rate in self.rates.items()}
+
+    def __contains__(self, currency: str) -> bool:
+        return currency in self.rates
+
+    def to_eur(self, amount: float, currency: str) -> float:
+        try:
+            return amount * self.inverse_rates[currency]
+        except KeyError:
+            raise UnknownCurrencyError(f"Unknown currency {currency}.") from None
+
+    def from_eur(self, amount: float, currency: str) -> float:
+        try:
+            return amount * self.rates[currency]
+        except KeyError:
+            raise UnknownCurrencyError(f"Unknown currency {currency}.") from None
+
+
+class HistoricalRates:
+    """EUR exchange rates per currency and day in an SQLite table keyed by (currency, day).
+
+    Looking up the rate of a day is a single B-tree search for the latest stored day not after it.
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS rates ("
+                "currency TEXT NOT NULL, day TEXT NOT NULL, rate REAL NOT NULL, "
+                "PRIMARY KEY (currency, day)) WITHOUT ROWID"
+            )
+
+    def store(self, rates_by_day: Dict[str, Dict[str, float]]) -> None:
+        """Insert or replace rates given as {"2024-01-31": {"USD": 1.08, ...}, ...}."""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO rates (currency, day, rate) VALUES (?, ?, ?)",
+                [
+                    (currency, day, float(rate))
+                    for day, day_rates in rates_by_day.items()
+                    for currency, rate in day_rates.items()
+                ],
+            )
+
+    def rate(self, currency: str, day: datetime.date) -> Optional[float]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT rate FROM rates WHERE currency = ? AND day <= ? ORDER BY day DESC LIMIT 1",
+                (currency, day.isoformat()),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def is_complete(self, currencies: List[str], start: datetime.date, end: datetime.date) -> bool:
+        """Whether every currency has a rate for every day from start to end."""
+        placeholders = ",".join("?" * len(currencies))
+        with self.lock:
+            (count,) = self.connection.execute(
+                f"SELECT COUNT(*) FROM rates WHERE day BETWEEN ? AND ? AND currency IN ({placeholders})",
+                (start.isoformat(), end.isoformat(), *currencies),
+            ).fetchone()
+        return count >= len(currencies) * ((end - start).days + 1)
+
+
+class RateService:
+    """EUR exchange rates served from memory and refreshed in the background.
+
+    The rates are kept in currencies.json as before. All known currencies are refreshed in one batched
+    "latest" request once they are older than ttl seconds, by a job on the bot's JobQueue, so handlers
+    never wait for the exchange rate API. base_url can point to a local stand-in of the API.
+
+    The rates of the last history_days days are also kept per day in rates.sqlite3, filled by the same
+    job with one "timeseries" request whenever days are missing, so that expenses entered for an earlier
+    day are converted with that day's rate.
+    """
+
+    def __init__(self, outdir: str, api_key: str, base_url: str, ttl: float, history_days: int):
+        self.outdir = outdir
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.ttl = ttl
+        self.history_days = history_days
+        self.history = HistoricalRates(os.path.join(outdir, "rates.sqlite3"))
+        self.lock = threading.Lock()
+        # replaced as a whole on every change, so readers never see a half updated table
+        self.converter = CurrencyConverter(read_currencies(outdir))
+        self.updated = os.path.getmtime(os.path.join(outdir, "currencies.json"))
+
+    @property
+    def rates(self) -> Dict[str, float]:
+        return self.converter.rates
+
+    def currencies(self) -> List[str]:
+        return sorted(self.rates.keys())
+
+    def fetch(self, symbols: Iterable[str]) -> Dict[str, float]:
+        """Get the current EUR rates of all symbols in a single request."""
+        response = run_request(
+            "GET",
+            f"{self.base_url}/latest",
+            request_body={"base": "EUR", "symbols": ",".join(symbols)},
+            request_headers={"apikey": self.api_key},
+        )
+        return {currency: float(rate) for currency, rate in response["rates"].items()}
+
+    def fetch_timeseries(
+        self, symbols: Iterable[str], start: datetime.date, end: datetime.date
+    ) -> Dict[str, Dict[str, float]]:
+        """Get the EUR rates of all symbols for every day from start to end in a single request."""
+        response = run_request(
+            "GET",
+            f"{self.base_url}/timeseries",
+            request_body={
+                "base": "EUR",
+                "symbols": ",".join(symbols),
+                "start_date": start.isoformat(),
+                "end_date": end.isoformat(),
+            },
+            request_headers={"apikey": self.api_key},
+        )
+        return response["rates"]
+
+    def to_eur(self, amount: float, currency: str, day: Optional[datetime.date] = None) -> float:
+        """Convert with the rate of the given day if it is known, with the current one otherwise.
+
+        Raises UnknownCurrencyError for currencies that haven't been added.
+        """
+        converter = self.converter
+        if day is not None and currency in converter:
+            rate = self.history.rate(currency, day)
+            if rate is not None:
+                return amount / rate
+        return converter.to_eur(amount, currency)
+
+    def backfill(self, symbols: List[str], force: bool = False) -> None:
+        """Fetch the rates of the last history_days days if any of them are missing."""
+        end = datetime.date.today()
+        start = end - datetime.timedelta(days=self.history_days - 1)
+        if len(symbols) == 0 or (not force and self.history.is_complete(symbols, start, end)):
+            return
+        self.history.store(self.fetch_timeseries(symbols, start, end))
+
+    def _store(self, fetched: Dict[str, float]) -> None:
+        with self.lock:
+            rates = dict(self.rates)
+            rates.update(fetched)
+            save_currencies(rates, self.outdir)
+            self.converter = CurrencyConverter(rates)
+            self.updated = time.time()
+
+    def add(self, currencies: List[str]) -> Dict[str, float]:
+        """Fetch the rates of new currencies in one request and keep them with the others.
+
+        Returns the rates that were found, currencies the API doesn't know are left out.
+        """
+        if len(currencies) == 0:
+            return dict()
+        fetched = self.fetch(currencies)
+        if len(fetched) == 0:
+            return fetched
+        self._store(fetched)
+        try:
+            self.backfill(list(fetched), force=True)
+        except Exception:
+            logger.exception("Fetching the past rates of %s failed", ", ".join(fetched))
+        return fetched
+
+    def refresh(self, force: bool = False) -> None:
+        if not force and time.time() - self.updated < self.ttl:
+            return
+        symbols = [currency for currency in self.rates if currency != "EUR"]
+        # without symbols the API would answer with the rates of every currency
+        if len(symbols) == 0:
+            return
+        try:
+            fetched = self.fetch(symbols)
+            self._store(fetched)
+            self.history.store({datetime.date.today().isoformat(): fetched})
+            self.backfill(symbols)
+        except Exception:
+            logger.exception("Refreshing the exchange rates failed, keeping the previous ones")
+            return
+        logger.info("Refreshed the exchange rates of %s currencies", len(symbols))
+
+    def schedule(self, job_queue: JobQueue, interval: float = 15 * 60) -> None:
+        """Check every interval seconds whether the rates are older than ttl and refresh them if they are."""
+        job_queue.run_repeating(lambda context: self.refresh(), interval=interval, first=0, name="refresh_rates")
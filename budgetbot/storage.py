@@ -0,0 +1,740 @@
+import contextlib
+import datetime
+import glob
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional
+
+from ledger import Ledger
+
+from tools import (
+    ChatLocks,
+    append_csv_rows,
+    atomic_write,
+    iter_csv_rows,
+    ledger_files,
+    ledger_path,
+    repair_csv_tail,
+    shard_dir,
+    truncate_last_csv_row,
+    upgrade_legacy_csv,
+)
+
+logger = logging.getLogger(__name__)
+
+# one lock per chat, shared by all storage layers and shard_ledgers
+chat_locks = ChatLocks()
+
+
+class Storage:
+    """Interface every ledger backend implements.
+
+    Rows are [date, amount, category, description] with a datetime.date, the amount in EUR and two strings.
+    Whole ledgers are read into a compact ledger.Ledger.
+    """
+
+    def __init__(self, outdir: str, df_columns: List[str]):
+        self.outdir = outdir
+        self.df_columns = df_columns
+
+    def read(self, chat_id) -> Ledger:
+        raise NotImplementedError
+
+    def iter_rows(self, chat_id) -> Iterator[List]:
+        """Stream the rows in insertion order without building a Ledger."""
+        raise NotImplementedError
+
+    def append(self, chat_id, row: List) -> None:
+        raise NotImplementedError
+
+    def append_many(self, chat_id, rows: List[List]) -> None:
+        for row in rows:
+            self.append(chat_id, row)
+
+    def delete_last(self, chat_id) -> Optional[List]:
+        """Delete the most recently added row and return it, or None if the ledger is empty."""
+        raise NotImplementedError
+
+    def clear(self, chat_id) -> None:
+        raise NotImplementedError
+
+    def sum_between(self, chat_id, start: datetime.date, end: datetime.date) -> float:
+        """Total amount of the rows from start to end (inclusive)."""
+        raise NotImplementedError
+
+    def count(self, chat_id) -> int:
+        """Number of rows of the chat."""
+        return sum(1 for _ in self.iter_rows(chat_id))
+
+    def upgrade(self) -> None:
+        """Convert data written by older versions, called once at startup."""
+
+    def recover(self) -> None:
+        """Repair what a crash may have left behind, called once at startup before upgrade."""
+
+    def close(self) -> None:
+        """Finish pending work, called once on shutdown."""
+
+
+class CsvStorage(Storage):
+    """One csv file per chat in outdir. This is the default backend."""
+
+    def read(self, chat_id) -> Ledger:
+        return Ledger.from_rows(self.iter_rows(chat_id))
+
+    def upgrade(self) -> None:
+        for path in ledger_files(self.outdir):
+            if upgrade_legacy_csv(path):
+                logger.info("Upgraded %s to ISO dates", path)
+
+    def recover(self) -> None:
+        for path in ledger_files(self.outdir):
+            removed = repair_csv_tail(path)
+            if removed > 0:
+                logger.warning("Removed %s bytes of an incomplete row from the end of %s", removed, path)
+
+    def iter_rows(self, chat_id) -> Iterator[List]:
+        return iter_csv_rows(self.outdir, chat_id)
+
+    def append(self, chat_id, row: List) -> None:
+        self.append_many(chat_id, [row])
+
+    def append_many(self, chat_id, rows: List[List]) -> None:
+        append_csv_rows(rows, self.outdir, chat_id, self.df_columns)
+
+    def delete_last(self, chat_id) -> Optional[List]:
+        try:
+            row = truncate_last_csv_row(self.outdir, chat_id)
+        except FileNotFoundError:
+            return None
+        if row is None:
+            return None
+        date, amount, category, description = row
+        return [datetime.date.fromisoformat(date), float(amount), category, description]
+
+    def clear(self, chat_id) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(ledger_path(self.outdir, chat_id))
+
+    def sum_between(self, chat_id, start: datetime.date, end: datetime.date) -> float:
+        return self.read(chat_id).sum(start, end)
+
+
+class SqliteStorage(Storage):
+    """All chats in a single SQLite database in WAL mode, indexed by (chat_id, date).
+
+    Dates are stored as ISO strings so that range queries can use the index.
+    """
+
+    def __init__(self, outdir: str, df_columns: List[str], filename: str = "budget.sqlite3"):
+        super().__init__(outdir, df_columns)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(outdir, filename), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS expenses ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "chat_id INTEGER NOT NULL, "
+                "date TEXT NOT NULL, "
+                "amount REAL NOT NULL, "
+                "category TEXT NOT NULL, "
+                "description TEXT NOT NULL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS expenses_chat_date ON expenses (chat_id, date)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS expenses_chat_id ON expenses (chat_id, id)")
+
+    @staticmethod
+    def _to_db_row(chat_id, row: List) -> tuple:
+        date, amount, category, description = row
+        return int(chat_id), date.isoformat(), float(amount), category, description
+
+    def read(self, chat_id) -> Ledger:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT date, amount, category, description FROM expenses WHERE chat_id = ? ORDER BY id",
+                (int(chat_id),),
+            ).fetchall()
+        return Ledger.from_rows([datetime.date.fromisoformat(r[0]), *r[1:]] for r in rows)
+
+    def iter_rows(self, chat_id, batch_size: int = 1000) -> Iterator[List]:
+        last_id = 0
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    "SELECT id, date, amount, category, description FROM expenses WHERE chat_id = ? AND id > ? "
+                    "ORDER BY id LIMIT ?",
+                    (int(chat_id), last_id, batch_size),
+                ).fetchall()
+            if len(rows) == 0:
+                return
+            last_id = rows[-1][0]
+            for r in rows:
+                yield [datetime.date.fromisoformat(r[1]), *r[2:]]
+
+    def append(self, chat_id, row: List) -> None:
+        self.append_many(chat_id, [row])
+
+    def append_many(self, chat_id, rows: List[List]) -> None:
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO expenses (chat_id, date, amount, category, description) VALUES (?, ?, ?, ?, ?)",
+                [self._to_db_row(chat_id, row) for row in rows],
+            )
+
+    def delete_last(self, chat_id) -> Optional[List]:
+        with self.lock, self.connection:
+            last = self.connection.execute(
+                "SELECT id, date, amount, category, description FROM expenses WHERE chat_id = ? "
+                "ORDER BY id DESC LIMIT 1",
+                (int(chat_id),),
+            ).fetchone()
+            if last is None:
+                return None
+            self.connection.execute("DELETE FROM expenses WHERE id = ?", (last[0],))
+        return [datetime.date.fromisoformat(last[1]), *last[2:]]
+
+    def clear(self, chat_id) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM expenses WHERE chat_id = ?", (int(chat_id),))
+
+    def count(self, chat_id) -> int:
+        with self.lock:
+            (count,) = self.connection.execute(
+                "SELECT COUNT(*) FROM expenses WHERE chat_id = ?", (int(chat_id),)
+            ).fetchone()
+        return count
+
+    def sum_between(self, chat_id, start: datetime.date, end: datetime.date) -> float:
+        with self.lock:
+            (total,) = self.connection.execute(
+                "SELECT COALESCE(SUM(amount), 0) FROM expenses WHERE chat_id = ? AND date BETWEEN ? AND ?",
+                (int(chat_id), start.isoformat(), end.isoformat()),
+            ).fetchone()
+        return float(total)
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+class StorageLayer(Storage):
+    """Base for layers stacked on top of another backend, delegating everything to it by default."""
+
+    def __init__(self, backend: Storage):
+        super().__init__(backend.outdir, backend.df_columns)
+        self.backend = backend
+
+    def read(self, chat_id) -> Ledger:
+        return self.backend.read(chat_id)
+
+    def iter_rows(self, chat_id) -> Iterator[List]:
+        return self.backend.iter_rows(chat_id)
+
+    def append(self, chat_id, row: List) -> None:
+        self.append_many(chat_id, [row])
+
+    def append_many(self, chat_id, rows: List[List]) -> None:
+        self.backend.append_many(chat_id, rows)
+
+    def delete_last(self, chat_id) -> Optional[List]:
+        return self.backend.delete_last(chat_id)
+
+    def clear(self, chat_id) -> None:
+        self.backend.clear(chat_id)
+
+    def sum_between(self, chat_id, start: datetime.date, end: datetime.date) -> float:
+        return self.backend.sum_between(chat_id, start, end)
+
+    def count(self, chat_id) -> int:
+        return self.backend.count(chat_id)
+
+    def upgrade(self) -> None:
+        self.backend.upgrade()
+
+    def recover(self) -> None:
+        self.backend.recover()
+
+    def close(self) -> None:
+        self.backend.close()
+
+
+def find_layer(storage: Storage, layer_type: type) -> Optional[Storage]:
+    """Return the first layer of the given type in a stack of storage layers, if there is one."""
+    while not isinstance(storage, layer_type):
+        if not isinstance(storage, StorageLayer):
+            return None
+        storage = storage.backend
+    return storage
+
+
+class LedgerCache(StorageLayer):
+    """Write-through cache of parsed ledgers in front of another backend.
+
+    Recently used chats are kept in memory and the least recently used ones are evicted
+    once the cached ledgers exceed max_bytes. The returned ledgers are shared and updated
+    in place by later writes of the chat, so callers must not modify them.
+    """
+
+    def __init__(self, backend: Storage, max_bytes: int):
+        super().__init__(backend)
+        self.max_bytes = max_bytes
+        # chat_locks serialize the backend I/O of a chat with its cache update, lock guards the bookkeeping
+        self.chat_locks = chat_locks
+        self.lock = threading.Lock()
+        self.ledgers = OrderedDict()
+        self.sizes = dict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _store(self, chat_id, ledger: Ledger) -> None:
+        size = ledger.nbytes()
+        with self.lock:
+            self._forget(chat_id)
+            self.ledgers[chat_id] = ledger
+            self.sizes[chat_id] = size
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self.ledgers) > 1:
+                evicted, _ = self.ledgers.popitem(last=False)
+                self.total_bytes -= self.sizes.pop(evicted)
+                self.evictions += 1
+
+    def _forget(self, chat_id) -> None:
+        if chat_id in self.ledgers:
+            del self.ledgers[chat_id]
+            self.total_bytes -= self.sizes.pop(chat_id)
+
+    def _cached(self, chat_id) -> Optional[Ledger]:
+        with self.lock:
+            return self.ledgers.get(chat_id)
+
+    def read(self, chat_id) -> Ledger:
+        with self.chat_locks(chat_id):
+            with self.lock:
+                if chat_id in self.ledgers:
+                    self.hits += 1
+                    self.ledgers.move_to_end(chat_id)
+                    return self.ledgers[chat_id]
+                self.misses += 1
+            ledger = self.backend.read(chat_id)
+            self._store(chat_id, ledger)
+            return ledger
+
+    def iter_rows(self, chat_id) -> Iterator[List]:
+        ledger = self._cached(chat_id)
+        if ledger is None:
+            return self.backend.iter_rows(chat_id)
+        return iter(ledger)
+
+    def append_many(self, chat_id, rows: List[List]) -> None:
+        with self.chat_locks(chat_id):
+            self.backend.append_many(chat_id, rows)
+            ledger = self._cached(chat_id)
+            if ledger is not None:
+                ledger.extend(rows)
+                self._store(chat_id, ledger)
+
+    def delete_last(self, chat_id) -> Optional[List]:
+        with self.chat_locks(chat_id):
+            row = self.backend.delete_last(chat_id)
+            ledger = self._cached(chat_id)
+            if row is not None and ledger is not None:
+                ledger.pop()
+                self._store(chat_id, ledger)
+            return row
+
+    def clear(self, chat_id) -> None:
+        with self.chat_locks(chat_id):
+            self.backend.clear(chat_id)
+            with self.lock:
+                self._forget(chat_id)
+
+    def sum_between(self, chat_id, start: datetime.date, end: datetime.date) -> float:
+        with self.chat_locks(chat_id):
+            ledger = self._cached(chat_id)
+            if ledger is None:
+                return self.backend.sum_between(chat_id, start, end)
+            return ledger.sum(start, end)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "chats": len(self.ledgers),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class RunningTotals(StorageLayer):
+    """Keeps per-chat aggregates up to date on every insert, delete and clear.
+
+    The total and the sums per day, month and category of the max_chats most recently used chats are kept
+    in memory, so neither summaries nor inserts touch the ledger or any other file. They are stored in
+    <chat_id>.totals.json next to the ledgers when a chat is evicted and on close(). The file of a chat is
+    removed when its totals first change after being read, so after a crash it is missing rather than stale
+    and is rebuilt from the ledger once. recover() also drops files that are unreadable, older than their csv
+    ledger or, with other backends, don't count as many rows as the ledger.
+    """
+
+    def __init__(self, backend: Storage, max_chats: int = 1024):
+        super().__init__(backend)
+        self.max_chats = max_chats
+        # chat_locks serialize the changes of a chat's totals, lock guards the bookkeeping
+        self.chat_locks = chat_locks
+        self.lock = threading.Lock()
+        self.cached = OrderedDict()
+        # chats whose totals changed since their file was written, always cached
+        self.dirty = set()
+
+    def _path(self, chat_id, create: bool = False) -> str:
+        return ledger_path(self.outdir, chat_id, ".totals.json", create)
+
+    @staticmethod
+    def _empty() -> Dict:
+        return {"count": 0, "total": 0.0, "days": {}, "months": {}, "categories": {}}
+
+    @staticmethod
+    def _add(totals: Dict, row: List, sign: int) -> None:
+        date, amount, category, _ = row
+        day = date.isoformat()
+        amount = sign * float(amount)
+        totals["count"] += sign
+        totals["total"] = round(totals["total"] + amount, 2)
+        for key, group in ((day, "days"), (day[:7], "months"), (category, "categories")):
+            value = round(totals[group].get(key, 0.0) + amount, 2)
+            if value == 0:
+                totals[group].pop(key, None)
+            else:
+                totals[group][key] = value
+
+    def _save(self, chat_id, totals: Dict) -> None:
+        try:
+            with atomic_write(self._path(chat_id, create=True), durable=False) as outfile:
+                json.dump(totals, outfile)
+        except OSError:
+            # the file is missing then, so the totals are rebuilt from the ledger instead
+            logger.exception("Writing the totals of chat %s failed", chat_id)
+
+    def _load(self, chat_id) -> Dict:
+        """The cached totals of the chat, read from its file or rebuilt from the ledger. Needs the chat lock."""
+        with self.lock:
+            if chat_id in self.cached:
+                self.cached.move_to_end(chat_id)
+                return self.cached[chat_id]
+        rebuilt = False
+        try:
+            with open(self._path(chat_id)) as file:
+                totals = json.load(file)
+        except FileNotFoundError:
+            totals = self._empty()
+            for row in self.backend.iter_rows(chat_id):
+                self._add(totals, row, 1)
+            rebuilt = totals["count"] > 0
+        evicted = []
+        with self.lock:
+            self.cached[chat_id] = totals
+            if rebuilt:
+                self.dirty.add(chat_id)
+            while len(self.cached) > self.max_chats and len(self.cached) > 1:
+                evicted_id, evicted_totals = self.cached.popitem(last=False)
+                if evicted_id in self.dirty:
+                    self.dirty.remove(evicted_id)
+                    evicted.append((evicted_id, evicted_totals))
+        for evicted_id, evicted_totals in evicted:
+            self._save_evicted(evicted_id, evicted_totals)
+        return totals
+
+    def _save_evicted(self, chat_id, totals: Dict) -> None:
+        chat_lock = self.chat_locks(chat_id)
+        # waiting for the lock while holding another chat's could deadlock, a busy chat's totals are rebuilt instead
+        if not chat_lock.acquire(blocking=False):
+            return
+        try:
+            with self.lock:
+                # read again by now, the cached totals are the current ones
+                if chat_id in self.cached:
+                    return
+            self._save(chat_id, totals)
+        finally:
+            chat_lock.release()
+
+    def _modify(self, chat_id) -> Dict:
+        """The cached totals of the chat, about to be changed. Needs the chat lock."""
+        totals = self._load(chat_id)
+        with self.lock:
+            if chat_id in self.dirty:
+                return totals
+            self.dirty.add(chat_id)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._path(chat_id))
+        return totals
+
+    def recover(self) -> None:
+        self.backend.recover()
+        for path in ledger_files(self.outdir, ".totals.json"):
+            ledger = path[: -len(".totals.json")] + ".csv"
+            try:
+                with open(path) as file:
+                    totals = json.load(file)
+                valid = set(totals) == set(self._empty())
+                if os.path.exists(ledger):
+                    stale = os.path.getmtime(ledger) > os.path.getmtime(path)
+                else:
+                    chat_id = os.path.basename(path)[: -len(".totals.json")]
+                    stale = valid and totals["count"] != self.backend.count(chat_id)
+            except ValueError:
+                valid = False
+            if not valid or stale:
+                os.remove(path)
+                logger.warning("Removed %s, it will be rebuilt from the ledger", path)
+
+    def totals(self, chat_id) -> Dict:
+        """A copy of the running totals of the chat."""
+        with self.chat_locks(chat_id):
+            totals = self._load(chat_id)
+            return {key: dict(value) if isinstance(value, dict) else value for key, value in totals.items()}
+
+    def append_many(self, chat_id, rows: List[List]) -> None:
+        with self.chat_locks(chat_id):
+            totals = self._modify(chat_id)
+            self.backend.append_many(chat_id, rows)
+            for row in rows:
+                self._add(totals, row, 1)
+
+    def delete_last(self, chat_id) -> Optional[List]:
+        with self.chat_locks(chat_id):
+            totals = self._modify(chat_id)
+            row = self.backend.delete_last(chat_id)
+            if row is not None:
+                self._add(totals, row, -1)
+            return row
+
+    def clear(self, chat_id) -> None:
+        with self.chat_locks(chat_id):
+            with self.lock:
+                self.cached.pop(chat_id, None)
+                self.dirty.discard(chat_id)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._path(chat_id))
+            self.backend.clear(chat_id)
+
+    def close(self) -> None:
+        with self.lock:
+            chat_ids = list(self.dirty)
+        for chat_id in chat_ids:
+            with self.chat_locks(chat_id):
+                with self.lock:
+                    totals = self.cached.get(chat_id) if chat_id in self.dirty else None
+                    self.dirty.discard(chat_id)
+                if totals is not None:
+                    self._save(chat_id, totals)
+        self.backend.close()
+
+
+class WriteBuffer(StorageLayer):
+    """Write-behind buffer that coalesces the inserts of a chat into one group commit.
+
+    Appended rows are kept in memory and handed to the backend in a single append_many once max_rows
+    are pending or window seconds after the first of them, by a background thread. Any other access
+    to a chat writes its pending rows first, so reads always include them, and close() writes all of
+    them on shutdown. Rows still pending when the process is killed are lost.
+    """
+
+    def __init__(self, backend: Storage, window: float, max_rows: int):
+        super().__init__(backend)
+        self.window = window
+        self.max_rows = max_rows
+        # chat_locks keep the group commits of a chat in order, condition guards pending and deadlines
+        self.chat_locks = chat_locks
+        self.condition = threading.Condition()
+        self.pending = dict()
+        self.deadlines = dict()
+        self.closed = False
+        self.commits = 0
+        self.thread = threading.Thread(target=self._run, name="write-buffer", daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.closed:
+                    now = time.monotonic()
+                    due = [chat_id for chat_id, deadline in self.deadlines.items() if deadline <= now]
+                    if len(due) > 0:
+                        break
+                    self.condition.wait(min(self.deadlines.values()) - now if self.deadlines else None)
+                if self.closed:
+                    return
+            for chat_id in due:
+                try:
+                    self.flush(chat_id)
+                except Exception:
+                    logger.exception("Writing the pending expenses of chat %s failed, retrying", chat_id)
+
+    def flush(self, chat_id) -> None:
+        """Write the pending rows of the chat to the backend. If that fails they stay pending for the next try."""
+        with self.chat_locks(chat_id):
+            with self.condition:
+                rows = self.pending.pop(chat_id, None)
+                self.deadlines.pop(chat_id, None)
+            if not rows:
+                return
+            try:
+                self.backend.append_many(chat_id, rows)
+            except BaseException:
+                with self.condition:
+                    # in front of the rows appended in the meantime
+                    self.pending[chat_id] = rows + self.pending.get(chat_id, [])
+                    self.deadlines.setdefault(chat_id, time.monotonic() + self.window)
+                    self.condition.notify()
+                raise
+            with self.condition:
+                self.commits += 1
+
+    def append_many(self, chat_id, rows: List[List]) -> None:
+        with self.condition:
+            pending = self.pending.setdefault(chat_id, [])
+            pending.extend(rows)
+            if len(pending) < self.max_rows and not self.closed:
+                if chat_id not in self.deadlines:
+                    self.deadlines[chat_id] = time.monotonic() + self.window
+                    self.condition.notify()
+                return
+        self.flush(chat_id)
+
+    def read(self, chat_id) -> Ledger:
+        self.flush(chat_id)
+        return self.backend.read(chat_id)
+
+    def iter_rows(self, chat_id) -> Iterator[List]:
+        self.flush(chat_id)
+        return self.backend.iter_rows(chat_id)
+
+    def delete_last(self, chat_id) -> Optional[List]:
+        with self.chat_locks(chat_id):
+            with self.condition:
+                pending = self.pending.get(chat_id)
+                if pending:
+                    # the row was never written, so it only has to be dropped
+                    row = pending.pop()
+                    if len(pending) == 0:
+                        del self.pending[chat_id]
+                        self.deadlines.pop(chat_id, None)
+                    return row
+            return self.backend.delete_last(chat_id)
+
+    def clear(self, chat_id) -> None:
+        with self.chat_locks(chat_id):
+            with self.condition:
+                self.pending.pop(chat_id, None)
+                self.deadlines.pop(chat_id, None)
+            self.backend.clear(chat_id)
+
+    def sum_between(self, chat_id, start: datetime.date, end: datetime.date) -> float:
+        self.flush(chat_id)
+        return self.backend.sum_between(chat_id, start, end)
+
+    def totals(self, chat_id) -> Dict:
+        """The running totals of the RunningTotals layer below, including the pending rows."""
+        self.flush(chat_id)
+        return self.backend.totals(chat_id)
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+            chat_ids = list(self.pending)
+        self.thread.join()
+        for chat_id in chat_ids:
+            self.flush(chat_id)
+        self.backend.close()
+
+
+storage_backends = {"csv": CsvStorage, "sqlite": SqliteStorage}
+
+
+def make_storage(config: Dict, outdir: str, df_columns: List[str]) -> Storage:
+    """Create the backend selected by the "storage" key in env.json (csv by default).
+
+    Parsed ledgers are cached in memory up to "ledger_cache_bytes" (64 MB by default, 0 disables the cache)
+    and running totals are kept on top of that, of up to "totals_cache_chats" chats (1024 by default) in memory.
+    New rows are written in groups, at most "write_buffer_window" seconds (1 by default, 0 writes every row right
+    away) or "write_buffer_rows" rows (100 by default) at a time.
+    """
+    storage = storage_backends[config.get("storage", "csv")](outdir, df_columns)
+    max_bytes = int(config.get("ledger_cache_bytes", 64 * 1024 * 1024))
+    if max_bytes > 0:
+        storage = LedgerCache(storage, max_bytes)
+    storage = RunningTotals(storage, int(config.get("totals_cache_chats", 1024)))
+    window = float(config.get("write_buffer_window", 1))
+    if window > 0:
+        storage = WriteBuffer(storage, window, int(config.get("write_buffer_rows", 100)))
+    return storage
+
+
+def migrate_csvs_to_sqlite(outdir: str, df_columns: List[str]) -> None:
+    """Bulk-import every per-chat csv in outdir into the SQLite backend. Chats already imported are skipped."""
+    source = CsvStorage(outdir, df_columns)
+    source.recover()
+    source.upgrade()
+    target = SqliteStorage(outdir, df_columns)
+    for path in sorted(ledger_files(outdir)):
+        chat_id = os.path.splitext(os.path.basename(path))[0]
+        if len(target.read(chat_id)) > 0:
+            logger.info("Skipping chat %s, already imported", chat_id)
+            continue
+        rows = list(source.iter_rows(chat_id))
+        target.append_many(chat_id, rows)
+        logger.info("Imported %s rows for chat %s", len(rows), chat_id)
+
+
+def shard_ledgers(outdir: str) -> int:
+    """Move the per-chat files of older versions from outdir into the sharded layout, returns how many.
+
+    Each chat's ledger and totals are moved with an atomic rename while its lock is held, so the bot can
+    keep running: tools.ledger_path finds a file in the old place until the rename and in the new one after.
+    """
+    chat_ids = set()
+    for suffix in (".csv", ".totals.json"):
+        for path in glob.glob(os.path.join(outdir, f"*{suffix}")):
+            chat_id = os.path.basename(path)[: -len(suffix)]
+            try:
+                chat_ids.add(int(chat_id))
+            except ValueError:
+                continue
+
+    moved = 0
+    for chat_id in sorted(chat_ids):
+        with chat_locks(chat_id):
+            for suffix in (".csv", ".totals.json"):
+                path = os.path.join(outdir, f"{chat_id}{suffix}")
+                if not os.path.exists(path):
+                    continue
+                directory = shard_dir(outdir, chat_id)
+                os.makedirs(directory, exist_ok=True)
+                os.replace(path, os.path.join(directory, os.path.basename(path)))
+                moved += 1
+    return moved
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    outdir = "budget_csvs"
+    if sys.argv[1:] == ["migrate"]:
+        migrate_csvs_to_sqlite(outdir, ["date", "amount", "category", "description"])
+    elif sys.argv[1:] == ["shard"]:
+        print(f"Moved {shard_ledgers(outdir)} files into {os.path.join(outdir, 'ledgers')}.")
+    else:
+        sys.exit("Usage: python3 storage.py migrate|shard")
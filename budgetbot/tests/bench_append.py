@@ -0,0 +1,38 @@
+"""Time recording one expense in ledgers of different sizes.
+
+Run it from the budgetbot directory with `python3 -m tests.bench_append`. Every insert appends and fsyncs a
+single line, so the time per insert should be about the same for a 10-row and a 100k-row ledger.
+"""
+
+import datetime
+import tempfile
+import time
+
+from storage import CsvStorage
+
+df_columns = ["date", "amount", "category", "description"]
+
+
+def time_inserts(storage: CsvStorage, chat_id: int, inserts: int) -> float:
+    """Average seconds per single-row insert."""
+    row = [datetime.date(2024, 1, 1), 12.5, "Eating Out", "pizza"]
+    started = time.perf_counter()
+    for _ in range(inserts):
+        storage.append(chat_id, row)
+    return (time.perf_counter() - started) / inserts
+
+
+def main(sizes=(10, 1_000, 100_000), inserts: int = 200) -> None:
+    with tempfile.TemporaryDirectory() as outdir:
+        storage = CsvStorage(outdir, df_columns)
+        for chat_id, size in enumerate(sizes):
+            day = datetime.date(2020, 1, 1)
+            storage.append_many(
+                chat_id,
+                [[day + datetime.timedelta(days=index // 10), 1.0, "Various", f"row {index}"] for index in range(size)],
+            )
+            print(f"{size:>7} rows: {time_inserts(storage, chat_id, inserts) * 1e6:8.1f} us per insert")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""Time converting an amount to EUR with the keyed converter and with the linear scan it replaced.
+
+Run it from the budgetbot directory with `python3 -m tests.bench_converter`.
+"""
+
+import itertools
+import string
+import timeit
+
+from rates import CurrencyConverter
+
+
+def linear_scan(rates, amount: float, selected: str) -> float:
+    """How send_info used to find the rate, looking at every currency."""
+    converted_amount = 0
+    for currency, exchange_rate in rates.items():
+        if selected == currency:
+            converted_amount = amount / exchange_rate
+    return converted_amount
+
+
+def main(number_of_currencies: int = 170, number: int = 200_000) -> None:
+    codes = ["".join(letters) for letters in itertools.product(string.ascii_uppercase, repeat=3)]
+    rates = {code: 1 + index / 100 for index, code in enumerate(codes[:number_of_currencies])}
+    converter = CurrencyConverter(rates)
+    # the last currency is the worst case of the scan and makes no difference to the lookup
+    currency = codes[number_of_currencies - 1]
+    assert abs(converter.to_eur(12.5, currency) - linear_scan(rates, 12.5, currency)) < 1e-9
+
+    for name, convert in (
+        ("keyed converter", lambda: converter.to_eur(12.5, currency)),
+        ("linear scan", lambda: linear_scan(rates, 12.5, currency)),
+    ):
+        seconds = min(timeit.repeat(convert, number=number, repeat=5)) / number
+        print(f"{name:>15}: {seconds * 1e6:.2f} us per conversion of {number_of_currencies} currencies")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Time the keyboards of one /spend step, built per step as before and taken from the KeyboardCache.
+
+Run it from the budgetbot directory with `python3 -m tests.bench_keyboards`. Each step builds (or looks
+up) its keyboard and serializes it, as sending a message with a reply markup does.
+"""
+
+import datetime
+import timeit
+from types import SimpleNamespace
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from keyboards import KeyboardCache
+from rates import CurrencyConverter
+from tools import DISPLAY_DATE_FORMAT
+
+number_of_days = 9
+# the categories of __main__.CATEGORIES
+categories = [
+    "Supermarket",
+    "Eating Out",
+    "Drinking",
+    "Busses etc",
+    "Car Rental",
+    "Petrol",
+    "LocalTransport",
+    "Flights",
+    "Hotels",
+    "Trips",
+    "Various",
+]
+
+
+def build_keyboard(labels) -> InlineKeyboardMarkup:
+    """How the handlers used to build their keyboards on every step."""
+    keyboard = [InlineKeyboardButton(label, callback_data=label) for label in labels]
+    chunk_size = 3
+    return InlineKeyboardMarkup([keyboard[x : x + chunk_size] for x in range(0, len(keyboard), chunk_size)])
+
+
+def main(number_of_currencies: int = 30, number: int = 2000) -> None:
+    rates = {f"C{index:02d}": 1.0 + index for index in range(number_of_currencies)}
+    rate_service = SimpleNamespace(converter=CurrencyConverter(rates))
+    cache = KeyboardCache(rate_service, number_of_days, categories)
+
+    def dates():
+        today = datetime.date.today()
+        return [(today - datetime.timedelta(days=x)).strftime(DISPLAY_DATE_FORMAT) for x in range(number_of_days)]
+
+    steps = {
+        "date": (lambda: build_keyboard(dates()).to_json(), lambda: cache.dates().to_json()),
+        "currency": (
+            lambda: build_keyboard(sorted(list(rate_service.converter.rates.keys()))).to_json(),
+            lambda: cache.currencies().to_json(),
+        ),
+        "category": (lambda: build_keyboard(categories).to_json(), lambda: cache.categories().to_json()),
+    }
+    for step, (before, after) in steps.items():
+        assert before() == after()
+        before_seconds = min(timeit.repeat(before, number=number, repeat=5)) / number
+        after_seconds = min(timeit.repeat(after, number=number, repeat=5)) / number
+        print(
+            f"{step:>8} keyboard: {before_seconds * 1e6:8.2f} us per step before, {after_seconds * 1e6:6.2f} us cached"
+        )
+
+
+if __name__ == "__main__":
+    main()
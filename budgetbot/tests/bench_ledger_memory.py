@@ -0,0 +1,81 @@
+"""Compare the memory per row of a Ledger with a list of row lists and a typed pandas DataFrame.
+
+Run it from the budgetbot directory with `python3 -m tests.bench_ledger_memory`. pandas is optional, the DataFrame
+is skipped without it.
+"""
+
+import datetime
+import gc
+import random
+import tracemalloc
+from typing import Callable, List, Tuple
+
+from ledger import Ledger
+
+columns = ["date", "amount", "category", "description"]
+categories = ["Eating Out", "Drinking", "Hotels", "Various", "Groceries", "Transport", "Rent", "Health", "Gifts"]
+descriptions = ["", "pizza", "beer", "hostel", "train ticket", "birthday present for a friend"]
+
+
+def make_rows(number_of_rows: int) -> List[List]:
+    rng = random.Random(0)
+    first_day = datetime.date(2020, 1, 1)
+    return [
+        [
+            first_day + datetime.timedelta(days=index * 3 // 10),
+            round(rng.uniform(0, 100), 2),
+            rng.choice(categories),
+            rng.choice(descriptions),
+        ]
+        for index in range(number_of_rows)
+    ]
+
+
+def allocated(build: Callable[[], object]) -> Tuple[int, object]:
+    """Bytes still allocated by build() once its result is complete, and the result."""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size, result
+
+
+def typed_frame(rows: List[List]):
+    import pandas as pd
+
+    frame = pd.DataFrame(rows, columns=columns)
+    frame[columns[0]] = pd.to_datetime(frame[columns[0]])
+    frame[columns[1]] = frame[columns[1]].astype("float64")
+    frame[columns[2]] = frame[columns[2]].astype("category")
+    return frame
+
+
+def main(number_of_rows: int = 100_000) -> None:
+    rows = make_rows(number_of_rows)
+    # the rows are shared input, only what each structure adds on top of them is counted
+    builds = {
+        "Ledger": (lambda: Ledger.from_rows(rows), Ledger.nbytes),
+        "list of rows": (lambda: [list(row) for row in rows], None),
+    }
+    try:
+        import pandas  # noqa: F401
+
+        # import pandas before measuring, so that its own modules aren't counted
+        typed_frame(rows[:10])
+        builds["typed DataFrame"] = (lambda: typed_frame(rows), lambda frame: frame.memory_usage(deep=True).sum())
+    except ImportError:
+        print("pandas isn't installed, skipping the DataFrame")
+
+    # tracemalloc doesn't see memory allocated outside of Python, e.g. by pyarrow for pandas' string columns
+    print(f"{'':>15}  {'tracemalloc':>11}  {'reported':>8}  ({number_of_rows} rows)")
+    for name, (build, reported) in builds.items():
+        size, result = allocated(build)
+        reported_size = f"{reported(result) / number_of_rows:.1f}" if reported is not None else "-"
+        print(f"{name:>15}: {size / number_of_rows:>7.1f} B/row  {reported_size:>8}")
+        del result
+
+
+if __name__ == "__main__":
+    main()
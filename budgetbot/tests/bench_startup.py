@@ -0,0 +1,57 @@
+"""Time importing the modules the bot starts with, each run in a fresh interpreter with python -X importtime.
+
+Run it from the budgetbot directory with `python3 -m tests.bench_startup`.
+"""
+
+import subprocess
+import sys
+from typing import Dict, Tuple
+
+# everything __main__ imports before the bot starts
+startup_modules = [
+    "telegram.ext",
+    "dispatch",
+    "bulk_import",
+    "drafts",
+    "keyboards",
+    "ledger",
+    "quick_entry",
+    "rates",
+    "storage",
+    "tools",
+    "webhook",
+]
+
+
+def import_times(modules) -> Dict[str, Tuple[int, int]]:
+    """Self and cumulative import time in microseconds of every module imported by `import <modules>`.
+
+    Nested imports keep their indentation in the keys, so top-level modules are those without leading spaces.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {', '.join(modules)}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = dict()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        own, cumulative, name = line[len("import time:") :].split("|")
+        times[name[1:]] = (int(own), int(cumulative))
+    return times
+
+
+def main(repeat: int = 5, top: int = 10) -> None:
+    runs = [import_times(startup_modules) for _ in range(repeat)]
+    fastest = min(runs, key=lambda times: sum(own for own, _ in times.values()))
+    print(f"{'total':>16}: {sum(own for own, _ in fastest.values()) / 1000:.1f} ms (fastest of {repeat} runs)")
+    top_level = [(name, cumulative) for name, (_, cumulative) in fastest.items() if not name.startswith(" ")]
+    for name, microseconds in sorted(top_level, key=lambda item: item[1], reverse=True)[:top]:
+        print(f"{name:>16}: {microseconds / 1000:.1f} ms")
+    print(f"{'pandas imported':>16}: {any(name.strip().split('.')[0] == 'pandas' for name in fastest)}")
+
+
+if __name__ == "__main__":
+    main()
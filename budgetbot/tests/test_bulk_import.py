@@ -0,0 +1,130 @@
+import datetime
+import io
+
+import pytest
+
+from bulk_import import parse_import_amount, parse_import_date, read_import, read_import_chunks
+from rates import CurrencyConverter
+
+categories = ["Supermarket", "Eating Out", "Various"]
+
+
+class FakeRates:
+    """The part of RateService the import uses, with fixed current rates."""
+
+    def __init__(self, rates):
+        self.converter = CurrencyConverter(rates)
+
+    def to_eur(self, amount, currency, day=None):
+        return self.converter.to_eur(amount, currency)
+
+
+rates = FakeRates({"EUR": 1.0, "USD": 2.0, "CZK": 25.0})
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("12.50", 12.5),
+        ("12,50", 12.5),
+        (" 7 ", 7.0),
+        # a single comma is a decimal comma, never a thousands separator
+        ("1,234", 1.234),
+        ("1.234", 1.234),
+        ("1.234,56", 1234.56),
+        ("1,234.56", 1234.56),
+        ("1.234.567,8", 1234567.8),
+        ("1 234,56", 1234.56),
+        ("-5,5", -5.5),
+    ],
+)
+def test_parse_import_amount(value, expected):
+    assert parse_import_amount(value) == pytest.approx(expected)
+
+
+# several commas without a dot could be either, so they are rejected
+@pytest.mark.parametrize("value", ["", "12 EUR", "abc", "nan", "inf", "1,234,567", "1,2,3.4.5"])
+def test_parse_import_amount_rejects(value):
+    with pytest.raises(ValueError, match="invalid amount"):
+        parse_import_amount(value)
+
+
+def test_parse_import_date():
+    assert parse_import_date(" 2024-03-01 ") == datetime.date(2024, 3, 1)
+    assert parse_import_date("01.03.2024") == datetime.date(2024, 3, 1)
+    with pytest.raises(ValueError, match="invalid date"):
+        parse_import_date("03/01/2024")
+
+
+def chunks(text: str, chunk_size: int = 5000):
+    return list(read_import_chunks(io.StringIO(text), rates, categories, chunk_size))
+
+
+def test_read_import_chunks():
+    text = (
+        "Date;Amount;Currency;Category;Description\n"
+        "2024-03-01;12,50;usd;eating out;pizza\n"
+        "\n"
+        "02.03.2024;3;;;\n"
+        "2024-03-03;1.234,56;CZK;Supermarket;weekly shop\n"
+    )
+    assert chunks(text) == [
+        (
+            [
+                [datetime.date(2024, 3, 1), 12.5, "USD", "Eating Out", "pizza"],
+                [datetime.date(2024, 3, 2), 3.0, "EUR", "Various", ""],
+                [datetime.date(2024, 3, 3), 1234.56, "CZK", "Supermarket", "weekly shop"],
+            ],
+            [],
+        )
+    ]
+
+
+def test_read_import_chunks_maps_unknown_categories_to_the_default():
+    text = "date,amount,category,description\n2024-03-01,5,Groceries,milk\n2024-03-02,6,Fuel,\n"
+    rows, rejected = chunks(text)[0]
+    assert [row[3:] for row in rows] == [["Various", "Groceries: milk"], ["Various", "Fuel"]]
+    assert rejected == []
+
+
+def test_read_import_chunks_rejects_rows():
+    text = (
+        "date,amount,currency\n"
+        "2024-03-01,12,50,EUR\n"
+        "2024-03-02,-8,EUR\n"
+        "2024-03-03,8,GBP\n"
+        "yesterday,8,EUR\n"
+        "2024-03-04,eight,EUR\n"
+        "2024-03-05,8,EUR,,\n"
+    )
+    rows, rejected = chunks(text)[0]
+    assert rows == [[datetime.date(2024, 3, 5), 8.0, "EUR", "Various", ""]]
+    assert rejected == [
+        (2, "4 values but 3 columns"),
+        (3, "negative amount -8.0, expenses have to be positive"),
+        (4, "unknown currency GBP"),
+        (5, "invalid date 'yesterday'"),
+        (6, "invalid amount 'eight'"),
+    ]
+
+
+def test_read_import_chunks_in_chunks():
+    text = "date\tamount\n" + "".join(f"2024-03-{day:02d}\t{day}\n" for day in range(1, 6))
+    result = chunks(text, chunk_size=2)
+    assert [[row[1] for row in rows] for rows, _ in result] == [[1, 2], [3, 4], [5]]
+
+
+@pytest.mark.parametrize("text", ["", "date,description\n2024-03-01,pizza\n", "amount\n5\n"])
+def test_read_import_chunks_needs_a_date_and_an_amount_column(text):
+    with pytest.raises(ValueError, match="header row"):
+        chunks(text)
+
+
+def test_read_import_converts_to_eur():
+    text = "date,amount,currency,category\n2024-03-01,10,USD,Various\n2024-03-02,10,CZK,\n2024-03-03,x,EUR,\n"
+    rows, rejected = read_import(io.StringIO(text), rates, categories)
+    assert rows == [
+        [datetime.date(2024, 3, 1), 5.0, "Various", ""],
+        [datetime.date(2024, 3, 2), 0.4, "Various", ""],
+    ]
+    assert rejected == [(4, "invalid amount 'x'")]
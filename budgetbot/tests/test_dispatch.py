@@ -0,0 +1,78 @@
+import datetime
+import threading
+import time
+
+import pytest
+
+from dispatch import ChatWorkerPool
+from storage import make_storage
+
+df_columns = ["date", "amount", "category", "description"]
+
+
+@pytest.mark.parametrize("backend", ["csv", "sqlite"])
+def test_chat_worker_pool_under_load(tmp_path, backend):
+    """Hundreds of chats sending at the same time: their updates run in parallel, those of a chat in order."""
+    storage = make_storage({"storage": backend, "write_buffer_window": 0.1}, str(tmp_path), df_columns)
+    chats = 300
+    rows_per_chat = 40
+    day = datetime.date(2024, 1, 1)
+
+    lock = threading.Lock()
+    active = set()
+    overlaps = []
+    most_active = [0]
+
+    def process(update):
+        chat_id, row = update
+        with lock:
+            if chat_id in active:
+                overlaps.append(chat_id)
+            active.add(chat_id)
+            most_active[0] = max(most_active[0], len(active))
+        try:
+            storage.append(chat_id, row)
+            # the Telegram round trip of a handler
+            time.sleep(0.001)
+        finally:
+            with lock:
+                active.discard(chat_id)
+
+    pool = ChatWorkerPool(process, workers=32)
+    start = threading.Barrier(chats)
+
+    def send(chat_id):
+        start.wait()
+        for index in range(rows_per_chat):
+            pool.submit(chat_id, (chat_id, [day, float(index), "Various", f"{chat_id}-{index}"]))
+
+    senders = [threading.Thread(target=send, args=(chat_id,)) for chat_id in range(chats)]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    pool.shutdown()
+
+    assert overlaps == []
+    assert most_active[0] > 1
+    for chat_id in range(chats):
+        assert [row[1] for row in storage.iter_rows(chat_id)] == [float(index) for index in range(rows_per_chat)]
+        assert storage.totals(chat_id)["count"] == rows_per_chat
+    storage.close()
+
+
+def test_chat_worker_pool_survives_failing_updates():
+    processed = []
+
+    def process(update):
+        if update == "bad":
+            raise ValueError(update)
+        processed.append(update)
+
+    pool = ChatWorkerPool(process, workers=2)
+    for update in ["a", "bad", "b"]:
+        pool.submit(1, update)
+    pool.shutdown()
+
+    assert processed == ["a", "b"]
+    assert pool.pending == {}
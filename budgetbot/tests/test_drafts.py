@@ -0,0 +1,112 @@
+import json
+import os
+
+import pytest
+
+import drafts
+from drafts import DraftStore
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(drafts, "time", fake)
+    return fake
+
+
+def test_update_and_pop(clock):
+    store = DraftStore()
+    store.update(1, date="01.03.2024")
+    draft = store.update(1, currency="EUR", amount=12.5, category="Various", description="")
+    assert draft.to_dict() == {
+        "date": "01.03.2024",
+        "currency": "EUR",
+        "amount": 12.5,
+        "category": "Various",
+        "description": "",
+        "updated": clock.now,
+    }
+    assert draft.is_complete()
+    assert store.pop(1) is draft
+    assert store.pop(1) is None
+    assert len(store) == 0
+
+
+def test_drafts_expire_after_the_ttl(clock):
+    store = DraftStore(ttl=60)
+    store.update(1, date="01.03.2024")
+    store.update(2, date="02.03.2024")
+    clock.now += 30
+    # an answer keeps the draft alive for another ttl
+    store.update(2, currency="EUR")
+    clock.now += 30
+    assert store.pop(1) is None
+    clock.now += 29
+    assert store.pop(2).to_dict()["currency"] == "EUR"
+
+
+def test_least_recently_updated_drafts_are_dropped(clock):
+    store = DraftStore(max_size=2)
+    for chat_id in (1, 2, 3):
+        store.update(chat_id, date="01.03.2024")
+        clock.now += 1
+    store.update(2, amount=5)
+    store.update(4, amount=6)
+    assert len(store) == 2
+    assert store.pop(1) is None
+    assert store.pop(3) is None
+    assert store.pop(2).amount == 5
+    assert store.pop(4).amount == 6
+
+
+def test_drafts_are_saved_by_flush_and_reloaded(tmp_path, clock):
+    path = str(tmp_path / "drafts.json")
+    store = DraftStore(ttl=60, path=path)
+    store.update(1, date="01.03.2024", currency="USD")
+    store.update(2, date="02.03.2024")
+    assert not os.path.exists(path)
+    store.flush()
+    with open(path) as file:
+        assert set(json.load(file)) == {"1", "2"}
+
+    # a restart
+    clock.now += 30
+    store.update(2, amount=7)
+    store.flush()
+    clock.now += 40
+    reloaded = DraftStore(ttl=60, path=path)
+    assert len(reloaded) == 1
+    draft = reloaded.pop(2)
+    assert (draft.date, draft.currency, draft.amount) == ("02.03.2024", None, 7)
+
+
+def test_flush_only_writes_changes(tmp_path, clock):
+    path = tmp_path / "drafts.json"
+    store = DraftStore(path=str(path))
+    store.flush()
+    assert not path.exists()
+    store.update(1, date="01.03.2024")
+    store.flush()
+    path.write_text("left alone")
+    store.flush()
+    store.pop(2)
+    store.flush()
+    assert path.read_text() == "left alone"
+    store.pop(1)
+    store.flush()
+    assert json.loads(path.read_text()) == {}
+
+
+@pytest.mark.parametrize("content", ["{", '{"1": {"unknown": 1}}', "[]"])
+def test_unreadable_drafts_are_ignored(tmp_path, clock, content):
+    path = tmp_path / "drafts.json"
+    path.write_text(content)
+    assert len(DraftStore(path=str(path))) == 0
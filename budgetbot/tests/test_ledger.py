@@ -0,0 +1,112 @@
+import datetime
+import random
+
+import pytest
+
+from ledger import Ledger
+
+categories = ["Eating Out", "Drinking", "Hotels", "Various", "ünïcödé"]
+descriptions = ["", "pizza", 'a "good" beer, or two', "first line\nsecond line", "€ ñ 漢字"]
+first_day = datetime.date(2024, 1, 1)
+
+
+def random_row(rng: random.Random, day: int) -> list:
+    return [
+        first_day + datetime.timedelta(days=day),
+        round(rng.uniform(0, 100), 2),
+        rng.choice(categories),
+        rng.choice(descriptions),
+    ]
+
+
+def model_sum(rows, start, end) -> float:
+    return sum(row[1] for row in rows if (start is None or start <= row[0]) and (end is None or row[0] <= end))
+
+
+def check(ledger: Ledger, rows: list, rng: random.Random) -> None:
+    assert len(ledger) == len(rows)
+    assert list(ledger) == rows
+    assert ledger.is_sorted() == (rows == sorted(rows, key=lambda row: row[0]))
+    if rows:
+        assert ledger.row(-1) == rows[-1]
+
+    start, end = sorted(first_day + datetime.timedelta(days=rng.randrange(-5, 70)) for _ in range(2))
+    for bounds in ((None, None), (start, None), (None, end), (start, end)):
+        assert ledger.sum(*bounds) == pytest.approx(model_sum(rows, *bounds))
+
+    category = rng.choice(categories + ["Unknown"])
+    filtered = [row for row in rows if start <= row[0] <= end and row[2] == category]
+    assert list(ledger.filter(start, end, category)) == filtered
+    assert list(ledger.filter(start, end)) == [row for row in rows if start <= row[0] <= end]
+
+    by_date = ledger.sorted_by_date()
+    # a stable sort, entries of one day keep their order
+    assert list(by_date) == sorted(rows, key=lambda row: row[0])
+    assert by_date.is_sorted()
+    assert by_date.sum(start, end) == pytest.approx(model_sum(rows, start, end))
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_ledger_against_a_list_of_rows(seed):
+    rng = random.Random(seed)
+    ledger = Ledger()
+    rows = []
+    day = 0
+    for _ in range(300):
+        operation = rng.random()
+        if operation < 0.6:
+            # mostly in date order, sometimes an expense of an earlier day
+            day = day + rng.randrange(3) if rng.random() < 0.9 else rng.randrange(day + 1)
+            row = random_row(rng, day)
+            ledger.append(row)
+            rows.append(row)
+        elif operation < 0.8:
+            assert ledger.pop() == (rows.pop() if rows else None)
+        else:
+            check(ledger, rows, rng)
+    check(ledger, rows, rng)
+
+
+def test_from_rows():
+    rows = [random_row(random.Random(0), day) for day in (3, 1, 2)]
+    ledger = Ledger.from_rows(rows)
+    assert list(ledger) == rows
+    assert not ledger.is_sorted()
+    assert ledger.categories == list(dict.fromkeys(row[2] for row in rows))
+
+
+def test_popping_restores_the_order():
+    ledger = Ledger.from_rows([random_row(random.Random(0), day) for day in (1, 2, 0)])
+    assert not ledger.is_sorted()
+    ledger.pop()
+    assert ledger.is_sorted()
+    assert ledger.sorted_by_date() is ledger
+
+
+def test_empty_ledger():
+    ledger = Ledger()
+    assert ledger.pop() is None
+    assert ledger.sum() == 0
+    assert ledger.sum(first_day, first_day) == 0
+    assert len(ledger.filter(first_day, first_day, "Various")) == 0
+    assert list(ledger.sorted_by_date()) == []
+
+
+def test_nbytes_grows_with_the_rows():
+    ledger = Ledger()
+    empty = ledger.nbytes()
+    ledger.extend(random_row(random.Random(0), day) for day in range(1000))
+    assert ledger.nbytes() > empty + 1000 * (4 + 8 + 4 + 4)
+
+
+def test_to_frame():
+    pd = pytest.importorskip("pandas")
+    rows = [random_row(random.Random(0), day) for day in (0, 0, 5)]
+    frame = Ledger.from_rows(rows).to_frame(["date", "amount", "category", "description"])
+    assert list(frame.columns) == ["date", "amount", "category", "description"]
+    assert list(frame["date"]) == [pd.Timestamp(row[0]) for row in rows]
+    assert list(frame["amount"]) == [row[1] for row in rows]
+    assert list(frame["category"]) == [row[2] for row in rows]
+    assert list(frame["description"]) == [row[3] for row in rows]
+    assert frame["amount"].dtype == "float64"
+    assert frame["category"].dtype == "category"
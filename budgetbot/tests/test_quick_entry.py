@@ -0,0 +1,83 @@
+import datetime
+
+import pytest
+
+from quick_entry import parse_date, parse_expense
+
+today = datetime.date(2025, 10, 18)
+currencies = {"EUR", "USD", "CZK"}
+categories = ["Eating Out", "Eating", "Drinking", "Various"]
+
+
+@pytest.mark.parametrize(
+    "token, expected",
+    [
+        ("today", today),
+        ("Yesterday", datetime.date(2025, 10, 17)),
+        ("01.05", datetime.date(2025, 5, 1)),
+        ("18.10", today),
+        ("01.05.2023", datetime.date(2023, 5, 1)),
+        # a date later this year stays in the future and is rejected by parse_expense
+        ("19.10", datetime.date(2025, 10, 19)),
+        ("1.5", None),
+        ("1.05", None),
+        ("01.5", None),
+        ("2.50", None),
+        ("1.5.2025", None),
+        ("31.02", None),
+        ("01.05.25", None),
+        ("2025-05-01", None),
+        ("beer", None),
+    ],
+)
+def test_parse_date(token, expected):
+    assert parse_date(token, today) == expected
+
+
+def test_parse_date_wraps_to_last_year_around_new_year():
+    january = datetime.date(2025, 1, 3)
+    assert parse_date("31.12", january) == datetime.date(2024, 12, 31)
+    assert parse_date("03.01", january) == january
+    # months ahead is a typo rather than last year's date
+    assert parse_date("05.11", january) == datetime.date(2025, 11, 5)
+    assert parse_date("29.02", datetime.date(2025, 1, 3)) is None
+
+
+@pytest.mark.parametrize(
+    "text, date, currency, amount, category, description",
+    [
+        ("12.50 USD Eating Out pizza yesterday", "17.10.2025", "USD", 12.5, "Eating Out", "pizza"),
+        ("12,5 eating out", "18.10.2025", "EUR", 12.5, "Eating Out", ""),
+        ("3 Eating bread", "18.10.2025", "EUR", 3.0, "Eating", "bread"),
+        ("7 czk Drinking 01.10", "01.10.2025", "CZK", 7.0, "Drinking", ""),
+        ("5 Various beer 1.5", "18.10.2025", "EUR", 5.0, "Various", "beer 1.5"),
+        ("5 Various 2 beers 01.01.2024", "01.01.2024", "EUR", 5.0, "Various", "2 beers"),
+        ("5 GBP Various", "18.10.2025", "GBP", 5.0, "Various", ""),
+    ],
+)
+def test_parse_expense(text, date, currency, amount, category, description):
+    draft = parse_expense(text, currencies, categories, today)
+    assert (draft.date, draft.currency, draft.amount, draft.category, draft.description) == (
+        date,
+        currency,
+        amount,
+        category,
+        description,
+    )
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "thanks",
+        "5",
+        "5 USD",
+        "5 Groceries milk",
+        "5.123 Various",
+        "-5 Various",
+        "5 Various 19.10",
+        "",
+    ],
+)
+def test_parse_expense_rejects(text):
+    assert parse_expense(text, currencies, categories, today) is None
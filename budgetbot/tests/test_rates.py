@@ -0,0 +1,157 @@
+import datetime
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from rates import RateService, UnknownCurrencyError
+
+# what the stand-in API knows, units per EUR
+api_rates = {"USD": 1.1, "GBP": 0.85, "CHF": 0.95}
+
+
+def day_rate(currency: str, day: datetime.date) -> float:
+    """A rate that differs from day to day, so that conversions show which day's rate was used."""
+    return round(api_rates[currency] * (1 + (datetime.date.today() - day).days / 100), 4)
+
+
+class StubApiHandler(BaseHTTPRequestHandler):
+    """The latest and timeseries endpoints of the exchange rate API, answered locally."""
+
+    server: "StubApi"
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        self.server.requests.append((url.path, params, self.headers.get("apikey")))
+        if self.server.failing:
+            self.send_response(503)
+            self.send_header("Retry-After", "0")
+            self.end_headers()
+            return
+
+        symbols = [symbol for symbol in params.get("symbols", "").split(",") if symbol in api_rates]
+        if url.path == "/latest":
+            body = {"base": "EUR", "rates": {symbol: api_rates[symbol] for symbol in symbols}}
+        elif url.path == "/timeseries":
+            start = datetime.date.fromisoformat(params["start_date"])
+            end = datetime.date.fromisoformat(params["end_date"])
+            days = [start + datetime.timedelta(days=offset) for offset in range((end - start).days + 1)]
+            body = {
+                "base": "EUR",
+                "rates": {day.isoformat(): {symbol: day_rate(symbol, day) for symbol in symbols} for day in days},
+            }
+        else:
+            self.send_error(404)
+            return
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class StubApi(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubApiHandler)
+        self.requests = []
+        self.failing = False
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+
+
+@pytest.fixture
+def api():
+    server = StubApi()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def outdir(tmp_path):
+    (tmp_path / "currencies.json").write_text(json.dumps({"EUR": 1.0, "USD": 1.0, "GBP": 1.0}))
+    return tmp_path
+
+
+def make_service(outdir, api, ttl: float = 0) -> RateService:
+    return RateService(str(outdir), "test-key", api.url, ttl, history_days=3)
+
+
+def test_refresh_fetches_all_currencies_in_one_request(outdir, api):
+    service = make_service(outdir, api)
+    service.refresh()
+
+    latest = [request for request in api.requests if request[0] == "/latest"]
+    assert latest == [("/latest", {"base": "EUR", "symbols": "USD,GBP"}, "test-key")]
+    assert service.rates == {"EUR": 1.0, "USD": 1.1, "GBP": 0.85}
+    assert json.loads((outdir / "currencies.json").read_text()) == service.rates
+
+    # conversions are served from memory
+    api.shutdown()
+    assert service.to_eur(11, "USD") == pytest.approx(10)
+    with pytest.raises(UnknownCurrencyError):
+        service.to_eur(1, "CHF")
+
+
+def test_refresh_waits_for_the_ttl(outdir, api):
+    service = make_service(outdir, api, ttl=60 * 60)
+    service.refresh()
+    assert api.requests == []
+
+    service.refresh(force=True)
+    assert len(api.requests) > 0
+
+
+def test_refresh_keeps_the_rates_while_the_api_is_down(outdir, api):
+    service = make_service(outdir, api)
+    api.failing = True
+    service.refresh()
+
+    assert len(api.requests) == 3
+    assert service.rates == {"EUR": 1.0, "USD": 1.0, "GBP": 1.0}
+
+
+def test_refresh_without_other_currencies_sends_no_request(outdir, api):
+    (outdir / "currencies.json").write_text(json.dumps({"EUR": 1.0}))
+    service = make_service(outdir, api)
+    service.refresh(force=True)
+    assert service.add([]) == {}
+
+    assert api.requests == []
+    assert service.rates == {"EUR": 1.0}
+    assert json.loads((outdir / "currencies.json").read_text()) == {"EUR": 1.0}
+
+
+def test_add_fetches_new_currencies_with_their_past_rates(outdir, api):
+    service = make_service(outdir, api)
+    assert service.add(["CHF", "XYZ"]) == {"CHF": 0.95}
+    assert [request[0] for request in api.requests] == ["/latest", "/timeseries"]
+    assert "CHF" in service.converter
+    assert "XYZ" not in service.converter
+
+    two_days_ago = datetime.date.today() - datetime.timedelta(days=2)
+    assert service.to_eur(100, "CHF", two_days_ago) == pytest.approx(100 / day_rate("CHF", two_days_ago))
+    # days before the kept history, and conversions without a day, use the current rate
+    assert service.to_eur(100, "CHF", two_days_ago - datetime.timedelta(days=30)) == pytest.approx(100 / 0.95)
+    assert service.to_eur(100, "CHF") == pytest.approx(100 / 0.95)
+
+
+def test_backfill_only_fetches_missing_days(outdir, api):
+    service = make_service(outdir, api)
+    service.backfill(["USD", "GBP"])
+    service.backfill(["USD", "GBP"])
+    assert [request[0] for request in api.requests] == ["/timeseries"]
+
+    today = datetime.date.today()
+    assert api.requests[0][1]["start_date"] == (today - datetime.timedelta(days=2)).isoformat()
+    assert api.requests[0][1]["end_date"] == today.isoformat()
+    assert service.history.is_complete(["USD", "GBP"], today - datetime.timedelta(days=2), today)
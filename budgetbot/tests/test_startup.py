@@ -0,0 +1,34 @@
+import subprocess
+import sys
+
+import pytest
+
+# the modules the bot needs to start, importing them must not load pandas
+bot_modules = [
+    "tools",
+    "storage",
+    "ledger",
+    "rates",
+    "dispatch",
+    "bulk_import",
+    "drafts",
+    "keyboards",
+    "quick_entry",
+    "webhook",
+]
+
+
+@pytest.mark.parametrize("module", bot_modules)
+def test_import_leaves_out_pandas(module):
+    # a fresh interpreter, other tests may have imported pandas already
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import sys, {module}; print(sorted(name for name in sys.modules if 'pandas' in name))",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip() == "[]"
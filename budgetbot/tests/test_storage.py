@@ -0,0 +1,339 @@
+import datetime
+import json
+import os
+import time
+
+import pytest
+
+from storage import CsvStorage, RunningTotals, SqliteStorage, Storage, WriteBuffer
+from ledger import Ledger
+from tools import ledger_path
+
+df_columns = ["date", "amount", "category", "description"]
+
+rows = [
+    [datetime.date(2024, 1, 30), 12.5, "Eating Out", "pizza"],
+    [datetime.date(2024, 1, 31), 3.0, "Drinking", "beer"],
+    [datetime.date(2024, 2, 1), 40.25, "Hotels", "hostel"],
+    [datetime.date(2024, 2, 1), 7.0, "Eating Out", "kebab"],
+]
+
+
+def expected_totals(ledger_rows):
+    totals = RunningTotals._empty()
+    for row in ledger_rows:
+        RunningTotals._add(totals, row, 1)
+    return totals
+
+
+@pytest.fixture(params=[CsvStorage, SqliteStorage])
+def backend(request, tmp_path):
+    backend = request.param(str(tmp_path), df_columns)
+    yield backend
+    backend.close()
+
+
+def reopen(backend):
+    """A new backend on the files of a closed one, e.g. after a restart."""
+    return type(backend)(backend.outdir, df_columns)
+
+
+def totals_path(backend, chat_id) -> str:
+    return ledger_path(backend.outdir, chat_id, ".totals.json")
+
+
+def test_totals(backend):
+    totals = RunningTotals(backend)
+    assert totals.totals(1) == RunningTotals._empty()
+    totals.append_many(1, rows[:2])
+    totals.append(1, rows[2])
+    totals.append(1, rows[3])
+    assert totals.totals(1) == {
+        "count": 4,
+        "total": 62.75,
+        "days": {"2024-01-30": 12.5, "2024-01-31": 3.0, "2024-02-01": 47.25},
+        "months": {"2024-01": 15.5, "2024-02": 47.25},
+        "categories": {"Eating Out": 19.5, "Drinking": 3.0, "Hotels": 40.25},
+    }
+    assert totals.totals(2)["count"] == 0
+    # a copy, so that the caller can't change the cached totals
+    totals.totals(1)["days"].clear()
+    assert totals.totals(1) == expected_totals(rows)
+
+
+def test_totals_are_rebuilt_from_the_ledger(backend):
+    backend.append_many(1, rows)
+    assert RunningTotals(backend).totals(1) == expected_totals(rows)
+
+
+def test_delete_last(backend):
+    totals = RunningTotals(backend)
+    totals.append_many(1, rows)
+    assert totals.delete_last(1) == rows[-1]
+    assert totals.delete_last(1) == rows[-2]
+    assert totals.totals(1) == expected_totals(rows[:2])
+    assert "2024-02-01" not in totals.totals(1)["days"]
+    totals.delete_last(1)
+    totals.delete_last(1)
+    assert totals.delete_last(1) is None
+    assert totals.totals(1) == RunningTotals._empty()
+
+
+def test_clear(backend):
+    totals = RunningTotals(backend)
+    totals.append_many(1, rows)
+    totals.append_many(2, rows[:1])
+    totals.close()
+    backend = reopen(backend)
+    totals = RunningTotals(backend)
+    totals.clear(1)
+    assert not os.path.exists(totals_path(backend, 1))
+    assert totals.totals(1) == RunningTotals._empty()
+    assert backend.count(1) == 0
+    assert totals.totals(2) == expected_totals(rows[:1])
+    backend.close()
+
+
+def test_inserts_dont_write_the_totals(backend):
+    totals = RunningTotals(backend)
+    totals.append_many(1, rows[:1])
+    totals.close()
+    assert os.path.exists(totals_path(backend, 1))
+    backend = reopen(backend)
+    totals = RunningTotals(backend)
+    totals.append_many(1, rows[1:2])
+    # removed on the first change, so that a crash doesn't leave stale totals behind
+    assert not os.path.exists(totals_path(backend, 1))
+    totals.append_many(1, rows[2:])
+    assert not os.path.exists(totals_path(backend, 1))
+    totals.close()
+    with open(totals_path(backend, 1)) as file:
+        assert json.load(file) == expected_totals(rows)
+
+
+def test_least_recently_used_totals_are_evicted_and_saved(backend):
+    totals = RunningTotals(backend, max_chats=2)
+    for chat_id in (1, 2, 3):
+        totals.append_many(chat_id, rows[: chat_id + 1])
+    assert list(totals.cached) == [2, 3]
+    with open(totals_path(backend, 1)) as file:
+        assert json.load(file) == expected_totals(rows[:2])
+    totals.totals(2)
+    totals.append(1, rows[3])
+    assert list(totals.cached) == [2, 1]
+    assert totals.totals(1) == expected_totals(rows[:2] + rows[3:])
+    assert totals.totals(3) == expected_totals(rows[:4])
+
+
+def test_recover_keeps_current_totals(backend):
+    totals = RunningTotals(backend)
+    totals.append_many(1, rows)
+    totals.close()
+    backend = reopen(backend)
+    RunningTotals(backend).recover()
+    assert os.path.exists(totals_path(backend, 1))
+    backend.close()
+
+
+def test_recover_removes_unreadable_totals(backend):
+    totals = RunningTotals(backend)
+    totals.append_many(1, rows)
+    totals.append_many(2, rows)
+    totals.close()
+    with open(totals_path(backend, 1), "w") as file:
+        file.write('{"count": 4, "tot')
+    with open(totals_path(backend, 2), "w") as file:
+        json.dump({"count": 4}, file)
+    backend = reopen(backend)
+    RunningTotals(backend).recover()
+    assert not os.path.exists(totals_path(backend, 1))
+    assert not os.path.exists(totals_path(backend, 2))
+    assert RunningTotals(backend).totals(1) == expected_totals(rows)
+    backend.close()
+
+
+def test_recover_removes_totals_older_than_the_csv_ledger(tmp_path):
+    backend = CsvStorage(str(tmp_path), df_columns)
+    totals = RunningTotals(backend)
+    totals.append_many(1, rows)
+    totals.close()
+    # e.g. a crash after writing the ledger, before the totals
+    backend.append(1, rows[0])
+    stat = os.stat(totals_path(backend, 1))
+    os.utime(ledger_path(backend.outdir, 1), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    RunningTotals(backend).recover()
+    assert not os.path.exists(totals_path(backend, 1))
+    assert RunningTotals(backend).totals(1) == expected_totals(rows + rows[:1])
+
+
+def test_recover_removes_totals_not_counting_the_sqlite_ledger(tmp_path):
+    backend = SqliteStorage(str(tmp_path), df_columns)
+    totals = RunningTotals(backend)
+    totals.append_many(1, rows)
+    totals.append_many(2, rows)
+    totals.close()
+    backend = SqliteStorage(str(tmp_path), df_columns)
+    backend.append(1, rows[0])
+    RunningTotals(backend).recover()
+    assert not os.path.exists(totals_path(backend, 1))
+    assert os.path.exists(totals_path(backend, 2))
+    assert RunningTotals(backend).totals(1) == expected_totals(rows + rows[:1])
+    backend.close()
+
+
+class FlakyStorage(Storage):
+    """In-memory backend whose next `failures` group commits raise an OSError."""
+
+    def __init__(self, failures: int = 0):
+        super().__init__("", df_columns)
+        self.failures = failures
+        self.ledgers = dict()
+        self.commits = []
+        self.closed = False
+
+    def read(self, chat_id) -> Ledger:
+        return Ledger.from_rows(self.ledgers.get(chat_id, []))
+
+    def iter_rows(self, chat_id):
+        return iter(list(self.ledgers.get(chat_id, [])))
+
+    def append_many(self, chat_id, rows) -> None:
+        if self.failures > 0:
+            self.failures -= 1
+            raise OSError("No space left on device")
+        self.commits.append((chat_id, list(rows)))
+        self.ledgers.setdefault(chat_id, []).extend(rows)
+
+    def delete_last(self, chat_id):
+        ledger = self.ledgers.get(chat_id)
+        return ledger.pop() if ledger else None
+
+    def clear(self, chat_id) -> None:
+        self.ledgers.pop(chat_id, None)
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def wait_for(condition, timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def flaky():
+    return FlakyStorage()
+
+
+def make_buffer(backend, window: float = 60, max_rows: int = 100) -> WriteBuffer:
+    return WriteBuffer(backend, window, max_rows)
+
+
+def test_write_buffer_groups_the_inserts_of_a_chat(flaky):
+    buffer = make_buffer(flaky)
+    for row in rows:
+        buffer.append(1, row)
+    buffer.append(2, rows[0])
+    assert flaky.commits == []
+    assert list(buffer.read(1)) == rows
+    assert flaky.commits == [(1, rows)]
+    assert list(buffer.iter_rows(2)) == rows[:1]
+    assert buffer.commits == 2
+    buffer.close()
+
+
+def test_write_buffer_writes_once_max_rows_are_pending(flaky):
+    buffer = make_buffer(flaky, max_rows=3)
+    buffer.append_many(1, rows[:2])
+    assert flaky.commits == []
+    buffer.append(1, rows[2])
+    assert flaky.commits == [(1, rows[:3])]
+    buffer.close()
+
+
+def test_write_buffer_writes_after_the_window(flaky):
+    buffer = make_buffer(flaky, window=0.05)
+    buffer.append_many(1, rows[:2])
+    buffer.append_many(1, rows[2:])
+    wait_for(lambda: len(flaky.commits) > 0)
+    assert flaky.commits == [(1, rows)]
+    assert buffer.pending == {}
+    buffer.close()
+
+
+def test_write_buffer_keeps_the_rows_of_a_failed_write(flaky):
+    flaky.failures = 2
+    buffer = make_buffer(flaky)
+    buffer.append_many(1, rows[:2])
+    for _ in range(2):
+        with pytest.raises(OSError):
+            buffer.flush(1)
+        assert buffer.pending == {1: rows[:2]}
+        assert 1 in buffer.deadlines
+    # rows appended after a failure go behind the ones that are retried
+    buffer.append_many(1, rows[2:])
+    assert list(buffer.read(1)) == rows
+    assert flaky.commits == [(1, rows)]
+    assert buffer.commits == 1
+    buffer.close()
+
+
+def test_write_buffer_retries_in_the_background(flaky):
+    flaky.failures = 3
+    buffer = make_buffer(flaky, window=0.02)
+    buffer.append_many(1, rows)
+    wait_for(lambda: len(flaky.commits) > 0)
+    assert flaky.failures == 0
+    assert flaky.ledgers == {1: rows}
+    buffer.close()
+
+
+def test_write_buffer_delete_last_drops_a_pending_row(flaky):
+    flaky.ledgers[1] = rows[:1]
+    buffer = make_buffer(flaky)
+    buffer.append_many(1, rows[1:3])
+    assert buffer.delete_last(1) == rows[2]
+    assert buffer.delete_last(1) == rows[1]
+    assert buffer.pending == {}
+    assert buffer.deadlines == {}
+    # the rows were never written
+    assert flaky.commits == []
+    assert buffer.delete_last(1) == rows[0]
+    assert buffer.delete_last(1) is None
+    buffer.close()
+
+
+def test_write_buffer_clear_discards_pending_rows(flaky):
+    flaky.ledgers[1] = rows[:1]
+    buffer = make_buffer(flaky)
+    buffer.append_many(1, rows[1:])
+    buffer.append_many(2, rows[:1])
+    buffer.clear(1)
+    assert list(buffer.read(1)) == []
+    assert list(buffer.read(2)) == rows[:1]
+    assert flaky.commits == [(2, rows[:1])]
+    buffer.close()
+
+
+def test_write_buffer_close_writes_pending_rows(flaky):
+    buffer = make_buffer(flaky)
+    buffer.append_many(1, rows[:2])
+    buffer.append_many(2, rows[2:])
+    buffer.close()
+    assert sorted(flaky.commits) == [(1, rows[:2]), (2, rows[2:])]
+    assert flaky.closed
+    assert not buffer.thread.is_alive()
+    # once closed, every insert is written right away
+    buffer.append(1, rows[3])
+    assert flaky.ledgers[1] == rows[:2] + rows[3:]
+
+
+def test_write_buffer_on_running_totals(tmp_path):
+    backend = CsvStorage(str(tmp_path), df_columns)
+    buffer = make_buffer(RunningTotals(backend))
+    buffer.append_many(1, rows)
+    assert buffer.totals(1) == expected_totals(rows)
+    assert buffer.sum_between(1, datetime.date(2024, 1, 31), datetime.date(2024, 2, 1)) == 50.25
+    buffer.close()
@@ -0,0 +1,341 @@
+import datetime
+import email.utils
+import io
+import itertools
+import os
+import threading
+import time
+
+import pytest
+import requests
+
+import tools
+from tools import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RequestFailedError,
+    append_csv_rows,
+    backoff_delay,
+    chunk_lines,
+    last_record_start,
+    ledger_path,
+    repair_csv_tail,
+    retry_after,
+    run_request,
+    truncate_last_csv_row,
+)
+
+df_columns = ["date", "amount", "category", "description"]
+header = b"date,amount,category,description\n"
+
+# descriptions with the characters that make csv records span several lines or need quoting
+rows = [
+    [datetime.date(2024, 1, 1), 12.5, "Eating Out", "pizza"],
+    [datetime.date(2024, 1, 2), 3.0, "Drinking", 'a "good" beer, or two'],
+    [datetime.date(2024, 1, 2), 40.25, "Hotels", "first line\nsecond line\n\nfourth"],
+    [datetime.date(2024, 1, 3), 7.0, "Various", "ünïcödé €"],
+    [datetime.date(2024, 1, 4), 1.0, "Various", ""],
+    [datetime.date(2024, 1, 5), 2.0, "Various", '"\n"'],
+]
+
+
+def write_ledger(outdir, chat_id, ledger_rows) -> bytes:
+    append_csv_rows(ledger_rows, str(outdir), chat_id, df_columns)
+    with open(ledger_path(str(outdir), chat_id), "rb") as file:
+        return file.read()
+
+
+@pytest.mark.parametrize("block_size", [1, 2, 5, 16, 4096])
+def test_last_record_start(tmp_path, block_size):
+    for count in range(1, len(rows) + 1):
+        content = write_ledger(tmp_path, count, rows[:count])
+        before = len(write_ledger(tmp_path, f"{count}-before", rows[: count - 1]))
+        position = last_record_start(io.BytesIO(content), len(content), block_size)
+        assert position == before
+
+
+def test_last_record_start_without_records():
+    assert last_record_start(io.BytesIO(header), len(header)) is None
+    assert last_record_start(io.BytesIO(header[:-1]), len(header) - 1) is None
+
+
+def test_last_record_start_without_trailing_newline():
+    content = header + b"2024-01-01,1.0,Various,a\n2024-01-02,2.0,Various,b"
+    assert last_record_start(io.BytesIO(content), len(content)) == content.rindex(b"2024-01-02")
+
+
+def test_truncate_last_csv_row_pops_rows_in_reverse(tmp_path):
+    write_ledger(tmp_path, 1, rows)
+    path = ledger_path(str(tmp_path), 1)
+    for count in range(len(rows), 0, -1):
+        date, amount, category, description = truncate_last_csv_row(str(tmp_path), 1)
+        assert [datetime.date.fromisoformat(date), float(amount), category, description] == rows[count - 1]
+        with open(path, "rb") as file:
+            assert file.read() == write_ledger(tmp_path, f"expected-{count}", rows[: count - 1])
+
+    with open(path, "rb") as file:
+        assert file.read() == header
+    assert truncate_last_csv_row(str(tmp_path), 1) is None
+
+
+def test_truncate_last_csv_row_of_an_empty_file(tmp_path):
+    path = ledger_path(str(tmp_path), 1, create=True)
+    open(path, "wb").close()
+    assert truncate_last_csv_row(str(tmp_path), 1) is None
+    assert os.path.getsize(path) == 0
+
+
+def test_chunk_lines_fills_chunks_up_to_the_limit():
+    assert list(chunk_lines(["ab", "cd", "e"], limit=5)) == ["ab\ncd", "e"]
+    assert list(chunk_lines(["abcde", "f"], limit=5)) == ["abcde", "f"]
+    assert list(chunk_lines([], limit=5)) == []
+    assert list(chunk_lines(["", ""], limit=5)) == ["\n"]
+
+
+def test_chunk_lines_keeps_all_lines():
+    lines = [f"{index:05d},{index * 1.5},Various,{'x' * (index % 37)}" for index in range(5000)]
+    chunks = list(chunk_lines(lines))
+    assert all(len(chunk) <= 4096 for chunk in chunks)
+    assert "\n".join(chunks).split("\n") == lines
+    # a chunk is only closed when the next line doesn't fit
+    consumed = 0
+    for chunk in chunks[:-1]:
+        consumed += chunk.count("\n") + 1
+        assert len(chunk) + 1 + len(lines[consumed]) > 4096
+
+
+def test_chunk_lines_splits_long_lines():
+    assert list(chunk_lines(["a" * 10, "b"], limit=4)) == ["aaaa", "aaaa", "aa\nb"]
+
+
+def test_chunk_lines_is_lazy():
+    lines = (f"line {index}" for index in itertools.count())
+    assert len(list(itertools.islice(chunk_lines(lines, limit=100), 3))) == 3
+
+
+def write_bytes(tmp_path, content: bytes) -> str:
+    path = str(tmp_path / "1.csv")
+    with open(path, "wb") as file:
+        file.write(content)
+    return path
+
+
+def read_bytes(path: str) -> bytes:
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def test_repair_csv_tail_keeps_intact_ledgers(tmp_path):
+    content = write_ledger(tmp_path, 1, rows)
+    for intact in (b"", header, content, header + b"01.01.2024,1.0,Various,legacy\n"):
+        path = write_bytes(tmp_path, intact)
+        assert repair_csv_tail(path) == 0
+        assert read_bytes(path) == intact
+
+
+@pytest.mark.parametrize("count", range(1, len(rows) + 1))
+def test_repair_csv_tail_cuts_a_torn_record(tmp_path, count):
+    intact = write_ledger(tmp_path, "intact", rows[: count - 1])
+    record = write_ledger(tmp_path, "complete", rows[:count])[len(intact) :]
+    # every way the last append can have been cut short
+    for length in range(1, len(record)):
+        path = write_bytes(tmp_path, intact + record[:length])
+        assert repair_csv_tail(path) == length
+        assert read_bytes(path) == intact
+
+
+def test_repair_csv_tail_cuts_garbage(tmp_path):
+    intact = write_ledger(tmp_path, "intact", rows)
+    for garbage in (
+        b"\x00" * 512,
+        b"2024-13-01,1.0,Various,x\n",
+        b"2024-01-01,not a number,Various,x\n",
+        b"\xff\xfe\n",
+    ):
+        path = write_bytes(tmp_path, intact + garbage)
+        assert repair_csv_tail(path) == len(garbage)
+        assert read_bytes(path) == intact
+
+
+def test_repair_csv_tail_cuts_a_torn_header(tmp_path):
+    path = write_bytes(tmp_path, header[:10])
+    assert repair_csv_tail(path) == 10
+    assert read_bytes(path) == b""
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def open_breaker(clock: FakeClock) -> CircuitBreaker:
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60, clock=clock)
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record_failure()
+    return breaker
+
+
+def test_circuit_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60, clock=FakeClock())
+    for _ in range(2):
+        breaker.record_failure()
+    breaker.record_success()
+    for _ in range(2):
+        breaker.record_failure()
+        assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+
+
+def test_circuit_breaker_lets_one_trial_through_after_the_timeout():
+    clock = FakeClock()
+    breaker = open_breaker(clock)
+    clock.now += 59.9
+    assert not breaker.allow()
+    clock.now += 0.1
+    assert breaker.allow()
+    # only one trial at a time
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+def test_circuit_breaker_failed_trial_keeps_it_open():
+    clock = FakeClock()
+    breaker = open_breaker(clock)
+    clock.now += 60
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+    clock.now += 59
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+
+
+def test_circuit_breaker_release_ends_only_the_own_trial():
+    clock = FakeClock()
+    breaker = open_breaker(clock)
+    clock.now += 60
+    other = threading.Thread(target=breaker.allow)
+    other.start()
+    other.join()
+    breaker.release()
+    assert not breaker.allow()
+    breaker.record_failure()
+    clock.now += 60
+    assert breaker.allow()
+    breaker.release()
+    # still open, the next call is a trial again
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def response(status_code: int, content: bytes = b"{}", headers=None) -> requests.Response:
+    result = requests.Response()
+    result.status_code = status_code
+    result._content = content
+    result.headers.update(headers or {})
+    return result
+
+
+@pytest.mark.parametrize(
+    "headers, expected",
+    [({}, None), ({"Retry-After": "7"}, 7), ({"Retry-After": "-3"}, 0), ({"Retry-After": "soon"}, None)],
+)
+def test_retry_after(headers, expected):
+    assert retry_after(response(429, headers=headers)) == expected
+
+
+def test_retry_after_http_date():
+    in_two_minutes = email.utils.formatdate(time.time() + 120, usegmt=True)
+    assert 115 < retry_after(response(503, headers={"Retry-After": in_two_minutes})) <= 120
+    assert retry_after(response(503, headers={"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"})) == 0
+
+
+def test_backoff_delay_grows_exponentially_up_to_max_delay():
+    for try_number, bound in ((1, 0.5), (2, 1), (3, 2), (6, 16), (10, 20)):
+        delays = [backoff_delay(try_number, base=0.5, max_delay=20) for _ in range(200)]
+        assert all(0 <= delay <= bound for delay in delays)
+        # full jitter, not a fixed delay
+        assert max(delays) > bound / 2 > min(delays)
+
+
+class FakeSession:
+    """Stands in for http_session, answering with the given responses or raising the given exceptions in turn."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def get(self, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+    post = patch = get
+
+
+@pytest.fixture
+def session(monkeypatch):
+    fake = FakeSession()
+    monkeypatch.setattr(tools, "http_session", fake)
+    monkeypatch.setattr(tools, "circuit_breakers", dict())
+    return fake
+
+
+def test_run_request_retries_connection_errors_and_5xx(session):
+    session.outcomes = [requests.ConnectionError("down"), response(503), response(200, b'{"rates": 1}')]
+    assert run_request("GET", "https://api.example/latest", max_delay=0) == {"rates": 1}
+    assert session.calls == 3
+    assert tools.circuit_breaker("https://api.example/").failures == 0
+
+
+def test_run_request_gives_up_after_num_of_tries(session):
+    session.outcomes = [response(500)] * 3
+    with pytest.raises(RequestFailedError, match="3 times"):
+        run_request("POST", "https://api.example/latest", max_delay=0)
+    assert tools.circuit_breaker("https://api.example/").failures == 3
+
+
+def test_run_request_doesnt_retry_client_errors(session):
+    session.outcomes = [response(400, b"bad request")]
+    with pytest.raises(RequestFailedError, match="bad request"):
+        run_request("PATCH", "https://api.example/latest", max_delay=0)
+    assert session.calls == 1
+
+
+def test_run_request_fails_fast_while_the_circuit_is_open(session):
+    session.outcomes = [requests.Timeout()] * 5
+    for _ in range(5):
+        with pytest.raises(RequestFailedError):
+            run_request("GET", "https://api.example/latest", num_of_tries=1)
+    with pytest.raises(CircuitOpenError):
+        run_request("GET", "https://api.example/latest")
+    assert session.calls == 5
+
+
+def test_run_request_rejects_unknown_request_types_before_calling(session):
+    with pytest.raises(ValueError):
+        run_request("DELETE", "https://api.example/latest")
+    assert session.calls == 0
+    assert "api.example" not in tools.circuit_breakers
+
+
+def test_run_request_ends_the_trial_on_unexpected_errors(session):
+    clock = FakeClock()
+    tools.circuit_breakers["api.example"] = open_breaker(clock)
+    clock.now += 60
+    session.outcomes = [RuntimeError("bug"), response(200)]
+    with pytest.raises(RuntimeError):
+        run_request("GET", "https://api.example/latest")
+    # the next call may try again instead of finding the trial still running forever
+    assert run_request("GET", "https://api.example/latest") == {}
+    assert tools.circuit_breakers["api.example"].opened_at is None
@@ -0,0 +1,52 @@
+import json
+import queue
+
+import pytest
+from webhook_client import measure, post_update, recorded_updates, serve, server_url, stand_in_updater
+
+secret_token = "the-secret-token"
+
+
+@pytest.fixture
+def listener():
+    updater = stand_in_updater()
+    server = serve(updater, secret_token)
+    yield updater, server
+    server.shutdown()
+    server.server_close()
+
+
+def test_accepts_updates_with_the_secret_token(listener):
+    updater, server = listener
+    for update in recorded_updates():
+        assert post_update(server_url(server), secret_token, json.dumps(update).encode()) == 200
+        assert updater.update_queue.get(timeout=5).update_id == update["update_id"]
+
+
+@pytest.mark.parametrize("token", ["", "wrong", "the-secret-tokeN", "the-secret-tökén"])
+def test_rejects_updates_without_the_secret_token(listener, token):
+    updater, server = listener
+    body = json.dumps(recorded_updates()[0]).encode()
+    assert post_update(server_url(server), token, body) == 403
+    assert updater.update_queue.empty()
+
+
+def test_rejects_other_paths(listener):
+    updater, server = listener
+    body = json.dumps(recorded_updates()[0]).encode()
+    assert post_update(server_url(server, "/other"), secret_token, body) == 404
+    assert updater.update_queue.empty()
+
+
+@pytest.mark.parametrize("body", [b"", b"{not json", b"[1, 2]"])
+def test_rejects_invalid_updates(listener, body):
+    updater, server = listener
+    assert post_update(server_url(server), secret_token, body) == 400
+    with pytest.raises(queue.Empty):
+        updater.update_queue.get(timeout=0.1)
+
+
+def test_measures_the_latency_to_the_handler():
+    latencies = measure(rounds=2)
+    assert len(latencies) == 2 * len(recorded_updates())
+    assert all(latency > 0 for latency in latencies)
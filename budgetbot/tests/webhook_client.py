@@ -0,0 +1,100 @@
+"""Stand-in for Telegram that POSTs recorded updates to the webhook listener and measures the latency.
+
+Run it from the budgetbot directory with `python3 -m tests.webhook_client [rounds]`. The listener runs
+locally with a dispatcher whose only handler notes when it got the update, so the numbers are the time
+from the POST to the handler, without the bot's own Telegram calls.
+"""
+
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from queue import Queue
+from typing import Dict, List
+
+from telegram import Update, User
+from telegram.ext import TypeHandler, Updater
+
+from webhook import WebhookServer
+
+recorded_updates_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recorded_updates.json")
+# never used to contact Telegram
+stand_in_token = "123456:stand-in"
+
+
+def stand_in_updater() -> Updater:
+    """An Updater whose bot knows who it is, so that starting the dispatcher doesn't call getMe."""
+    updater = Updater(stand_in_token)
+    updater.bot._bot = User(123456, "Budget Bot", is_bot=True, username="budget_42_bot")
+    return updater
+
+
+def recorded_updates() -> List[Dict]:
+    with open(recorded_updates_path) as file:
+        return json.load(file)
+
+
+def serve(updater: Updater, secret_token: str, url_path: str = "/webhook") -> WebhookServer:
+    """Start the webhook listener on a free local port in a background thread."""
+    server = WebhookServer(updater, "127.0.0.1", 0, url_path, secret_token)
+    threading.Thread(target=server.serve_forever, name="webhook", daemon=True).start()
+    return server
+
+
+def server_url(server: WebhookServer, url_path: str = None) -> str:
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}{url_path or server.url_path}"
+
+
+def post_update(url: str, secret_token: str, body: bytes) -> int:
+    """POST body like Telegram does and return the HTTP status of the answer."""
+    request = urllib.request.Request(
+        url,
+        data=body,
+        method="POST",
+        headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret_token},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def measure(rounds: int) -> List[float]:
+    """Seconds from POSTing each recorded update until the dispatcher ran a handler for it."""
+    updater = stand_in_updater()
+    handled = Queue()
+    updater.dispatcher.add_handler(TypeHandler(Update, lambda update, context: handled.put(time.perf_counter())))
+    dispatcher_thread = threading.Thread(target=updater.dispatcher.start, name="dispatcher")
+    dispatcher_thread.start()
+    server = serve(updater, "stand-in-secret")
+
+    latencies = []
+    try:
+        bodies = [json.dumps(update).encode() for update in recorded_updates()]
+        for _ in range(rounds):
+            for body in bodies:
+                started = time.perf_counter()
+                status = post_update(server_url(server), "stand-in-secret", body)
+                if status != 200:
+                    raise RuntimeError(f"The listener answered {status}")
+                latencies.append(handled.get(timeout=10) - started)
+    finally:
+        server.shutdown()
+        server.server_close()
+        updater.dispatcher.stop()
+        dispatcher_thread.join()
+    return latencies
+
+
+if __name__ == "__main__":
+    latencies = sorted(measure(int(sys.argv[1]) if len(sys.argv) > 1 else 100))
+    print(
+        f"{len(latencies)} updates, POST to handler: median {statistics.median(latencies) * 1000:.2f} ms, "
+        f"95th percentile {latencies[int(len(latencies) * 0.95)] * 1000:.2f} ms, max {latencies[-1] * 1000:.2f} ms"
+    )
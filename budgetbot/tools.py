@@ -1,21 +1,343 @@
+import contextlib
+import csv
+import datetime
+import email.utils
+import glob
+import gzip
+import hashlib
+import io
+import itertools
 import json
+import logging
 import os
-from typing import Dict
-import pandas as pd
+import random
+import re
+import threading
+import time
+import weakref
+from typing import IO, Callable, Dict, Iterable, Iterator, List, Optional
+from urllib.parse import urlparse
 import requests
+from requests.adapters import HTTPAdapter
 
+logger = logging.getLogger(__name__)
 
-def read_csv(outdir: str, chat_id, df_columns) -> pd.DataFrame:
+# Ledgers store ISO dates, users see (and older versions stored) DISPLAY_DATE_FORMAT
+DATE_FORMAT = "%Y-%m-%d"
+DISPLAY_DATE_FORMAT = "%d.%m.%Y"
+legacy_date_pattern = re.compile(r"^\d{2}\.\d{2}\.\d{4},")
+
+
+@contextlib.contextmanager
+def atomic_write(path: str, mode: str = "w", durable: bool = True, **kwargs) -> Iterator[IO]:
+    """Open <path>.tmp for writing and move it over path once the block has completed.
+
+    Readers, and the file after a crash, see either the old or the complete new content. With durable
+    the data and the rename are fsync'd before returning. Files that are checked at startup anyway skip
+    that to spare the SD card some writes.
+    """
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, mode, **kwargs) as file:
+            yield file
+            if durable:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+    if durable:
+        directory = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+
+def shard_dir(outdir: str, chat_id) -> str:
+    """The directory of a chat's files in the sharded layout, outdir/ledgers/<2 hex digits>/<2 hex digits>.
+
+    The digits are taken from a hash of the chat id, so the chats spread evenly over up to 65536 small
+    directories.
+    """
+    digest = hashlib.sha1(str(chat_id).encode()).hexdigest()
+    return os.path.join(outdir, "ledgers", digest[:2], digest[2:4])
+
+
+def ledger_path(outdir: str, chat_id, suffix: str = ".csv", create: bool = False) -> str:
+    """Path of a chat's ledger (or other per-chat file) in the sharded layout.
+
+    Files of older versions directly in outdir are used where they are until they have been moved,
+    see storage.shard_ledgers. With create the shard directory is created if it doesn't exist yet.
+    """
+    flat = os.path.join(outdir, f"{chat_id}{suffix}")
+    if os.path.exists(flat):
+        return flat
+    directory = shard_dir(outdir, chat_id)
+    if create:
+        os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{chat_id}{suffix}")
+
+
+def ledger_files(outdir: str, suffix: str = ".csv") -> List[str]:
+    """All per-chat files with the suffix, in both the flat and the sharded layout."""
+    return glob.glob(os.path.join(outdir, f"*{suffix}")) + glob.glob(
+        os.path.join(outdir, "ledgers", "*", "*", f"*{suffix}")
+    )
+
+
+def remove_temp_files(outdir: str) -> List[str]:
+    """Delete the <file>.tmp leftovers of writes that were interrupted by a crash."""
+    paths = ledger_files(outdir, ".tmp")
+    for path in paths:
+        os.remove(path)
+    return paths
+
+
+def upgrade_legacy_csv(path: str) -> bool:
+    """Rewrite a ledger with %d.%m.%Y dates to ISO dates, keeping the row order. Returns whether it was legacy."""
+    with open(path, newline="") as file:
+        file.readline()
+        if not legacy_date_pattern.match(file.readline()):
+            return False
+        file.seek(0)
+        reader = csv.reader(file)
+        with atomic_write(path, newline="") as outfile:
+            writer = csv.writer(outfile, lineterminator="\n")
+            writer.writerow(next(reader))
+            for date, *rest in reader:
+                writer.writerow([datetime.datetime.strptime(date, DISPLAY_DATE_FORMAT).date(), *rest])
+    return True
+
+
+def append_csv_rows(rows: Iterable[List], outdir: str, chat_id, df_columns) -> None:
+    """Append rows to the chat's csv without rewriting it.
+
+    The header is only written when the file is created, and the lines are fsync'd once
+    so an insert costs the same regardless of how many rows the file already has.
+    """
+    path = ledger_path(outdir, chat_id, create=True)
+    file = open(path, "a", newline="")
+    start = file.tell()
     try:
-        df = pd.read_csv(os.path.join(outdir, f"{chat_id}.csv"))
-    except Exception:
-        df = pd.DataFrame(columns=df_columns)
+        with file:
+            writer = csv.writer(file, lineterminator="\n")
+            if start == 0:
+                writer.writerow(df_columns)
+            writer.writerows(rows)
+            file.flush()
+            os.fsync(file.fileno())
+    except BaseException:
+        # drop a partly written group, so that the rows can be written again as a whole
+        os.truncate(path, start)
+        raise
+
+
+def iter_csv_rows(outdir: str, chat_id) -> Iterator[List]:
+    """Stream the rows of the chat's csv without parsing the whole file at once."""
+    for _ in range(2):
+        try:
+            file = open(ledger_path(outdir, chat_id), newline="")
+            break
+        except FileNotFoundError:
+            # the ledger may have been moved into the sharded layout right after its path was looked up
+            continue
+    else:
+        return
+    with file:
+        reader = csv.reader(file)
+        next(reader, None)
+        for date, amount, category, description in reader:
+            yield [datetime.date.fromisoformat(date), float(amount), category, description]
+
+
+def last_record_start(file: IO[bytes], end: int, block_size: int = 4096) -> Optional[int]:
+    """Offset of the last record of a csv file of end bytes, or None if there is only the header.
+
+    The file is read backwards from the end only until the start of the last record is found, so the
+    cost does not depend on the file size. A newline inside a quoted field is recognised by the odd
+    number of quotes following it.
+    """
+    file.seek(end - 1)
+    limit = end - 1 if file.read(1) == b"\n" else end
+
+    position = end
+    while position > 0:
+        position = max(0, position - block_size)
+        file.seek(position)
+        data = file.read(end - position)
+        index = data.rfind(b"\n", 0, limit - position)
+        while index >= 0:
+            if data[index + 1 :].count(b'"') % 2 == 0:
+                return position + index + 1
+            index = data.rfind(b"\n", 0, index)
+    return None
+
+
+def truncate_last_csv_row(outdir: str, chat_id) -> Optional[List[str]]:
+    """Remove the last row of the chat's csv in place and return it, or None if there are no rows.
+
+    The truncation is a single metadata update, so after a crash the file holds either the old or
+    the new content.
+    """
+    path = ledger_path(outdir, chat_id)
+    with open(path, "r+b") as file:
+        end = file.seek(0, os.SEEK_END)
+        if end == 0:
+            return None
+        record_start = last_record_start(file, end)
+        if record_start is None:
+            # only the header is left
+            return None
+
+        file.seek(record_start)
+        record = file.read().decode("UTF-8")
+        file.truncate(record_start)
+        file.flush()
+        os.fsync(file.fileno())
+
+    return next(csv.reader(io.StringIO(record)))
+
+
+def is_valid_record(record: bytes) -> bool:
+    """Whether record is one complete ledger line, with an ISO or a legacy date."""
+    if not record.endswith(b"\n"):
+        return False
+    try:
+        rows = list(csv.reader(io.StringIO(record.decode("UTF-8"))))
+        if len(rows) != 1 or len(rows[0]) != 4:
+            return False
+        date, amount, _, _ = rows[0]
+        float(amount)
+        if legacy_date_pattern.match(f"{date},"):
+            datetime.datetime.strptime(date, DISPLAY_DATE_FORMAT)
+        else:
+            datetime.date.fromisoformat(date)
+    except (UnicodeDecodeError, csv.Error, ValueError):
+        return False
+    return True
+
+
+def repair_csv_tail(path: str) -> int:
+    """Cut off a record that was only partly written when the bot crashed. Returns the number of bytes removed.
+
+    Appends are the only writes to a ledger, so damage can only be at its end. Checking the last record
+    is enough when it is intact, only otherwise the file is scanned for the end of the last valid record.
+    """
+    with open(path, "r+b") as file:
+        end = file.seek(0, os.SEEK_END)
+        if end == 0:
+            return 0
+        file.seek(0)
+        header = file.readline()
+        if not header.endswith(b"\n"):
+            good = 0
+        else:
+            record_start = last_record_start(file, end)
+            if record_start is not None:
+                file.seek(record_start)
+                if is_valid_record(file.read()):
+                    return 0
+            elif end == len(header):
+                return 0
+            # the last record is damaged, or its unmatched quote hid where the records start
+
+            file.seek(len(header))
+            good = len(header)
+            position = good
+            record = b""
+            for line in file:
+                record += line
+                if record.count(b'"') % 2 == 1:
+                    continue
+                position += len(record)
+                if is_valid_record(record):
+                    good = position
+                record = b""
+
+        file.truncate(good)
+        file.flush()
+        os.fsync(file.fileno())
+    return end - good
 
-    return df
 
+def chunk_lines(lines: Iterable[str], limit: int = 4096) -> Iterator[str]:
+    """Join lines with newlines into consecutive chunks of at most limit characters.
 
-def write_csv(df, outdir: str, chat_id):
-    df.to_csv(os.path.join(outdir, f"{chat_id}.csv"), header=True, index=False)
+    Lines are consumed lazily and every character is copied once, so the whole text is never
+    built as a single string. A line longer than limit is split over several chunks.
+    """
+    chunk = []
+    length = 0
+    for line in lines:
+        for start in range(0, max(len(line), 1), limit):
+            piece = line[start : start + limit]
+            if chunk and length + 1 + len(piece) > limit:
+                yield "\n".join(chunk)
+                chunk = []
+                length = 0
+            length += len(piece) + (1 if chunk else 0)
+            chunk.append(piece)
+    if chunk:
+        yield "\n".join(chunk)
+
+
+export_formats = {"csv": ".csv", "gzip": ".csv.gz", "parquet": ".parquet"}
+
+
+def export_rows(rows: Iterable[List], columns: List[str], file_format: str = "csv") -> io.BytesIO:
+    """Write rows into an in-memory csv, gzipped csv or parquet file, batch by batch.
+
+    Parquet needs the optional pyarrow package, an ImportError is raised without it.
+    """
+    buffer = io.BytesIO()
+    if file_format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema(
+            [
+                (columns[0], pa.date32()),
+                (columns[1], pa.float64()),
+                (columns[2], pa.string()),
+                (columns[3], pa.string()),
+            ]
+        )
+        with pq.ParquetWriter(buffer, schema) as writer:
+            rows = iter(rows)
+            for batch in iter(lambda: list(itertools.islice(rows, 10000)), []):
+                writer.write_table(pa.Table.from_pylist([dict(zip(columns, row)) for row in batch], schema=schema))
+    else:
+        raw = gzip.GzipFile(fileobj=buffer, mode="wb") if file_format == "gzip" else buffer
+        text = io.TextIOWrapper(raw, encoding="UTF-8", newline="")
+        writer = csv.writer(text, lineterminator="\n")
+        writer.writerow(columns)
+        writer.writerows(rows)
+        text.flush()
+        text.detach()
+        if raw is not buffer:
+            raw.close()
+
+    buffer.seek(0)
+    return buffer
+
+
+class ChatLocks:
+    """Hands out one re-entrant lock per chat. A lock is dropped again once no thread holds a reference to it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = weakref.WeakValueDictionary()
+
+    def __call__(self, chat_id) -> threading.RLock:
+        with self.lock:
+            chat_lock = self.locks.get(chat_id)
+            if chat_lock is None:
+                chat_lock = threading.RLock()
+                self.locks[chat_id] = chat_lock
+            return chat_lock
 
 
 def read_config(outdir: str) -> Dict:
@@ -31,10 +353,105 @@ def read_currencies(outdir: str) -> Dict:
 
 
 def save_currencies(currencies: Dict, outdir: str) -> None:
-    with open(f"{outdir}/currencies.json", "w") as outfile:
+    with atomic_write(f"{outdir}/currencies.json") as outfile:
         json.dump(currencies, outfile)
 
 
+class RequestFailedError(Exception):
+    pass
+
+
+class CircuitOpenError(RequestFailedError):
+    pass
+
+
+class CircuitBreaker:
+    """Stops calling a host after failure_threshold consecutive failed requests for reset_timeout seconds.
+
+    Once the timeout has passed a single trial request is let through, its outcome closes the circuit
+    again or keeps it open for another reset_timeout.
+    """
+
+    def __init__(
+        self, failure_threshold: int = 5, reset_timeout: float = 60, clock: Callable[[], float] = time.monotonic
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        # the thread sending the trial request, if one is running
+        self.trial_thread = None
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_thread is not None or self.clock() - self.opened_at < self.reset_timeout:
+                return False
+            self.trial_thread = threading.get_ident()
+            return True
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_thread = None
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            self.trial_thread = None
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+
+    def release(self) -> None:
+        """End the calling thread's trial without an outcome, e.g. when it raised an unrelated error."""
+        with self.lock:
+            if self.trial_thread == threading.get_ident():
+                self.trial_thread = None
+
+
+# one pooled keep-alive session for all requests, retries are done by run_request itself
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=0))
+http_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=0))
+circuit_breakers = dict()
+circuit_breakers_lock = threading.Lock()
+retry_status_codes = {429, 500, 502, 503, 504}
+
+
+def circuit_breaker(url: str) -> CircuitBreaker:
+    host = urlparse(url).netloc
+    with circuit_breakers_lock:
+        breaker = circuit_breakers.get(host)
+        if breaker is None:
+            breaker = CircuitBreaker()
+            circuit_breakers[host] = breaker
+        return breaker
+
+
+def retry_after(response: requests.Response) -> Optional[float]:
+    """Seconds to wait according to the Retry-After header, given either as seconds or as an HTTP date."""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(try_number: int, base: float = 1, max_delay: float = 60) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(max_delay, base * 2 ** (try_number - 1)))
+
+
 def run_request(
     request_type: str,
     url: str,
@@ -44,44 +461,67 @@ def run_request(
     timeout: int = 30,
     media: Dict = None,
     request_headers=None,
-    num_of_tries=1,
+    num_of_tries=3,
+    max_delay: float = 60,
 ) -> Dict:
-    success = False
-    response = None
-    expected_status_code = None
-    try_number = 1
+    """Send a request through the shared session and return the decoded json response.
 
-    while not success and try_number <= num_of_tries:
-        try_number = try_number + 1
-        try:
-            if request_type == "GET":
-                expected_status_code = 200
-                if request_headers is None:
-                    request_headers = {"Content-Type": "application/json", "Authorization": bearer}
-                response = requests.get(url=url, headers=request_headers, params=request_body, timeout=timeout)
-            elif request_type == "POST":
-                expected_status_code = 200
-                if media is not None:
-                    response = requests.post(url, request_body, files=media, timeout=timeout)
-                else:
-                    response = requests.post(
-                        url=url, headers={"Content-Type": "application/json"}, json=request_body, timeout=timeout
+    Connection errors, timeouts and 429/5xx responses are retried up to num_of_tries times in total,
+    waiting with exponential backoff or as long as the Retry-After header asks, up to max_delay seconds.
+    Requests to a host whose circuit breaker is open fail right away with a CircuitOpenError.
+    """
+    if request_type not in ("GET", "POST", "PATCH"):
+        raise ValueError("Wrong request type!")
+    breaker = circuit_breaker(url)
+
+    try:
+        for try_number in range(1, num_of_tries + 1):
+            if not breaker.allow():
+                raise CircuitOpenError(f"Not calling {urlparse(url).netloc}, it failed too often recently.")
+
+            delay = None
+            try:
+                if request_type == "GET":
+                    if request_headers is None:
+                        request_headers = {"Content-Type": "application/json", "Authorization": bearer}
+                    response = http_session.get(url=url, headers=request_headers, params=request_body, timeout=timeout)
+                elif request_type == "POST":
+                    if media is not None:
+                        response = http_session.post(url, request_body, files=media, timeout=timeout)
+                    else:
+                        response = http_session.post(
+                            url=url, headers={"Content-Type": "application/json"}, json=request_body, timeout=timeout
+                        )
+                elif request_type == "PATCH":
+                    response = http_session.patch(
+                        url=url, headers={"Content-Type": "application/json"}, data=request_json, timeout=timeout
                     )
-            elif request_type == "PATCH":
-                expected_status_code = 200
-                response = requests.patch(
-                    url=url, headers={"Content-Type": "application/json"}, data=request_json, timeout=timeout
-                )
+            except requests.RequestException as e:
+                breaker.record_failure()
+                logger.warning("%s %s failed (try %s of %s): %s", request_type, url, try_number, num_of_tries, e)
             else:
-                raise Exception("Wrong request type!")
-            success = True
-        except Exception as e:
-            print(e)
-
-    if not success:
-        raise Exception(f"The request failed {num_of_tries} times.")
+                if response.status_code == 200:
+                    breaker.record_success()
+                    return json.loads(response.content.decode("UTF-8"))
+                if response.status_code not in retry_status_codes:
+                    # the service is up, the request itself is wrong
+                    breaker.record_success()
+                    raise RequestFailedError(response.content.decode("UTF-8"))
+                breaker.record_failure()
+                delay = retry_after(response)
+                logger.warning(
+                    "%s %s returned %s (try %s of %s)",
+                    request_type,
+                    url,
+                    response.status_code,
+                    try_number,
+                    num_of_tries,
+                )
 
-    if response.status_code != expected_status_code:
-        raise Exception(response.content.decode("UTF-8"))
+            if try_number < num_of_tries:
+                time.sleep(min(max_delay, backoff_delay(try_number, max_delay=max_delay) if delay is None else delay))
+    finally:
+        # a no-op once the outcome of a trial is recorded, but an unexpected error mustn't keep the host blocked
+        breaker.release()
 
-    return json.loads(response.content.decode("UTF-8"))
+    raise RequestFailedError(f"The request failed {num_of_tries} times.")
@@ -0,0 +1,97 @@
+import hmac
+import json
+import logging
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+from urllib.parse import urlparse
+
+from telegram import Update
+from telegram.ext import Updater
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    """Accepts the updates Telegram POSTs to the webhook and puts them on the dispatcher's queue."""
+
+    server: "WebhookServer"
+
+    def do_POST(self) -> None:
+        if self.path != self.server.url_path:
+            self.send_error(404)
+            return
+
+        # headers are decoded as latin-1, compare bytes so that any header value is simply a mismatch
+        secret_token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode("latin-1")
+        if not hmac.compare_digest(secret_token, self.server.secret_token):
+            self.send_error(403)
+            return
+
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            update = Update.de_json(data, self.server.updater.bot)
+        except Exception:
+            logger.exception("Received an invalid update")
+            self.send_error(400)
+            return
+
+        # answer right away, the dispatcher handles the update in its own thread
+        self.server.updater.update_queue.put(update)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(format, *args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, updater: Updater, listen: str, port: int, url_path: str, secret_token: str):
+        super().__init__((listen, port), WebhookRequestHandler)
+        self.updater = updater
+        self.url_path = url_path
+        self.secret_token = secret_token.encode()
+
+
+def run_webhook(updater: Updater, webhook: Dict) -> None:
+    """Receive updates through a webhook instead of polling, until SIGINT or SIGTERM.
+
+    webhook is the "webhook" entry of env.json: the public "url" Telegram posts to, the "secret_token" Telegram
+    sends along with every update and optionally the local "listen" address and "port" (default 0.0.0.0:8443).
+    A reverse proxy is expected to terminate TLS in front of the listener.
+    """
+    server = WebhookServer(
+        updater,
+        webhook.get("listen", "0.0.0.0"),
+        int(webhook.get("port", 8443)),
+        urlparse(webhook["url"]).path or "/",
+        webhook["secret_token"],
+    )
+
+    dispatcher_thread = threading.Thread(target=updater.dispatcher.start, name="dispatcher")
+    dispatcher_thread.start()
+    if updater.job_queue is not None:
+        updater.job_queue.start()
+
+    updater.bot.set_webhook(url=webhook["url"], api_kwargs={"secret_token": webhook["secret_token"]})
+
+    def stop(signum, frame) -> None:
+        # shutdown() waits for serve_forever() to return, so it can't be called from the serving thread
+        threading.Thread(target=server.shutdown, name="webhook-shutdown").start()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    logger.info("Listening for updates on %s:%s%s", *server.server_address[:2], server.url_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if updater.job_queue is not None:
+            updater.job_queue.stop()
+        updater.dispatcher.stop()
+        dispatcher_thread.join()